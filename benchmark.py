@@ -0,0 +1,470 @@
+#!/usr/bin/env python -tt
+"""
+Benchmarks for the kde bandwidth selection.
+
+Daniel B. Smith, PhD
+"""
+
+from __future__ import division
+
+import sys
+import csv
+import json
+import inspect
+import timeit
+import argparse
+import multiprocessing
+import numpy as np
+import scipy.optimize
+import scipy.fftpack
+import kde
+import dgp_class as dgp
+import dgp_class2d as dgp2d
+
+def _histogram_a2(x, N):
+    """
+    Squared DCT coefficients of the histogram of x, as built inside kde.kde
+    """
+    DataHist = np.histogram(x, bins=N)[0]/len(x)
+    return (scipy.fftpack.dct(DataHist, norm=None)[1:]/2)**2
+
+def _best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def bench_fixed_point(sizes=(2**14, 2**20), Nsamp=10000, repeat=3, t=1e-4):
+    """
+    Compares kde.fixed_point with both precisions of kde.FixedPointSolver.
+
+    Parameters
+    ----------
+    sizes: list of ints
+           Mesh sizes to time
+    Nsamp: int
+           Number of samples drawn from the claw density for the histogram
+    repeat: int
+            Each timing is the best of `repeat` runs
+    t: float
+       Point at which a single evaluation is timed
+
+    Returns
+    -------
+    List of dicts, one per (N, method), holding the time of a single
+    evaluation, the time of the full brentq solve including setup, and the
+    resulting t_star.
+    """
+    x = dgp.Claw().sample(size=Nsamp)
+    results = []
+    for N in sizes:
+        a2 = _histogram_a2(x, N)
+        I = [iN*iN for iN in xrange(1, N)]
+        methods = [('fixed_point',
+                    lambda: lambda t: kde.fixed_point(t, Nsamp, I, a2))]
+        for precision in ('float128', 'log'):
+            methods.append((precision, lambda p=precision:
+                            kde.FixedPointSolver(Nsamp, a2, p)))
+        for name, setup in methods:
+            func = setup()
+            solve = lambda: scipy.optimize.brentq(setup(), 0, 0.1)
+            results.append({'N': N, 'method': name,
+                            'call': _best_time(lambda: func(t), repeat),
+                            'solve': _best_time(solve, repeat),
+                            't_star': solve()})
+    return results
+
+def _test_models():
+    """
+    Instances of the dgp_class test densities. LogNormal is left out as
+    its pdf is undefined on the negative part of the kde mesh.
+    """
+    classes = [(name, cls) for name, cls in inspect.getmembers(dgp)
+               if inspect.isclass(cls) and not cls in (dgp.dgp, dgp.LogNormal)]
+    return [(name, cls()) for name, cls in classes]
+
+def ise(model, mesh, density):
+    """
+    Integrated squared error of density against model.pdf on mesh
+    """
+    return np.trapz((np.asarray(density) - model.pdf(mesh))**2, mesh)
+
+def bench_binning(sizes=(2**10, 2**12, 2**14), Nsamp=10000, reps=10):
+    """
+    Accuracy versus time of simple and linear binning in kde.kde on the
+    dgp_class test densities.
+
+    Parameters
+    ----------
+    sizes: list of ints
+           Mesh sizes N
+    Nsamp: int
+           Number of samples per replication
+    reps: int
+          Number of replications. Every (N, binning) pair sees the same
+          samples.
+
+    Returns
+    -------
+    List of dicts, one per (model, N, binning), holding the mean ISE and
+    the mean time of kde.kde.
+    """
+    results = []
+    for name, model in _test_models():
+        samples = [model.sample(size=Nsamp) for _ in xrange(reps)]
+        for N in sizes:
+            for binning in ('simple', 'linear'):
+                errors = []
+                times = []
+                for x in samples:
+                    start = timeit.default_timer()
+                    out = kde.kde(x, N=N, binning=binning)
+                    times.append(timeit.default_timer() - start)
+                    if out is not None:
+                        errors.append(ise(model, out[1], out[2]))
+                results.append({'model': name, 'N': N, 'binning': binning,
+                                'ise': np.mean(errors) if errors else np.nan,
+                                'time': np.mean(times)})
+    return results
+
+def bench_kde2d(sizes=(2**6, 2**7, 2**8), Nsamp=10000, reps=10):
+    """
+    Accuracy and time of kde.kde2d on the dgp_class2d test densities.
+
+    Parameters
+    ----------
+    sizes: list of ints
+           Mesh sizes N along each axis
+    Nsamp: int
+           Number of samples per replication
+    reps: int
+          Number of replications
+
+    Returns
+    -------
+    List of dicts, one per (model, N), holding the mean ISE and the mean
+    time of kde.kde2d.
+    """
+    models = [(name, cls()) for name, cls in inspect.getmembers(dgp2d)
+              if inspect.isclass(cls) and issubclass(cls, dgp2d.dgp2d)
+              and cls is not dgp2d.dgp2d]
+    results = []
+    for name, model in models:
+        samples = [model.sample(size=Nsamp) for _ in xrange(reps)]
+        for N in sizes:
+            errors = []
+            times = []
+            for x in samples:
+                start = timeit.default_timer()
+                out = kde.kde2d(x, N=N)
+                times.append(timeit.default_timer() - start)
+                if out is not None:
+                    (mx, my), density = out[1:]
+                    f = model.pdf(mx[:, None], my[None, :])
+                    errors.append(np.trapz(np.trapz((density - f)**2, my),
+                                           mx))
+            results.append({'model': name, 'N': N,
+                            'ise': np.mean(errors) if errors else np.nan,
+                            'time': np.mean(times)})
+    return results
+
+def bench_exact(Nsamp=10000, Npoints=10000, tol=1e-8):
+    """
+    kde.evaluate_exact against the interpolated mesh of kde.fit on the
+    dgp_class test densities, at the bandwidth kde selects.
+
+    Returns
+    -------
+    List of dicts, one per model, with the largest difference between the
+    two, the ISE of each against model.pdf on the model mesh, and the time
+    of each evaluation.
+    """
+    results = []
+    for name, model in _test_models():
+        x = model.sample(size=Nsamp)
+        fitted = kde.fit(x)
+        if fitted is None:
+            continue
+        points = model.mesh(Npoints)
+        start = timeit.default_timer()
+        exact = kde.evaluate_exact(x, points, fitted.bandwidth, tol=tol)
+        time_exact = timeit.default_timer() - start
+        start = timeit.default_timer()
+        grid = fitted.evaluate(points)
+        time_grid = timeit.default_timer() - start
+        results.append({'model': name, 'max_diff': abs(exact - grid).max(),
+                        'ise_exact': ise(model, points, exact),
+                        'ise_grid': ise(model, points, grid),
+                        'time_exact': time_exact, 'time_grid': time_grid})
+    return results
+
+# Ways of passing the same samples, or weights, in chunks
+_LAYOUTS = {'array': lambda x, n: x,
+            'list': lambda x, n: [x[i:i+n] for i in xrange(0, len(x), n)],
+            'tuple': lambda x, n: tuple(x[i:i+n]
+                                        for i in xrange(0, len(x), n)),
+            'generator': lambda x, n: (x[i:i+n]
+                                       for i in xrange(0, len(x), n))}
+
+def bench_layouts(Nsamp=10000, chunk=3000, seed=0):
+    """
+    kde of weighted Claw samples passed in each pair of data and weights
+    layouts of _LAYOUTS, against the kde of the plain arrays. Streams of
+    data are only paired with weights chunked the same way.
+
+    Returns
+    -------
+    List of dicts, one per pair, with the largest difference of the
+    density from the plain arrays', or the error raised, and the time.
+    """
+    state = np.random.RandomState(seed)
+    x = _model('Claw').sample(size=Nsamp, seed=state)
+    w = state.uniform(size=Nsamp)
+    MIN, MAX = x.min() - 1, x.max() + 1
+    reference = kde.kde(x, MIN=MIN, MAX=MAX, weights=w)[2]
+    results = []
+    for data_layout in sorted(_LAYOUTS):
+        for weights_layout in sorted(_LAYOUTS):
+            if (data_layout == 'array') != (weights_layout == 'array'):
+                continue
+            row = {'data': data_layout, 'weights': weights_layout,
+                   'max_diff': np.nan, 'error': ''}
+            start = timeit.default_timer()
+            try:
+                data = _LAYOUTS[data_layout](x, chunk)
+                weights = _LAYOUTS[weights_layout](w, chunk)
+                density = kde.kde(data, MIN=MIN, MAX=MAX, chunksize=chunk,
+                                  weights=weights)[2]
+                row['max_diff'] = abs(density - reference).max()
+            except ValueError as e:
+                row['error'] = str(e)
+            row['time'] = timeit.default_timer() - start
+            results.append(row)
+    return results
+
+# Samples on which the fixed point equation has several roots, and the
+# bracket once jumped from the smallest to one 25-50 times larger
+_ROOT_CASES = (('TenModes', (2, 3, 8, 9)), ('AsymClaw', range(10)))
+_ROOT_METHODS = ('kde', 'log', 'warm_below', 'warm_at', 'many', 'select')
+
+def bench_roots(cases=_ROOT_CASES, Nsamp=500, rtol=1e-6):
+    """
+    The bandwidth of every entry point that solves the fixed point
+    equation, on the seeds of each case: kde in both precisions, warm
+    started below and at its own t_star, kde_many and select_bandwidths.
+    They should all find the smallest root.
+
+    Returns
+    -------
+    List of dicts, one per model and seed, with each bandwidth, the
+    largest relative difference between them, and whether that is within
+    rtol.
+    """
+    results = []
+    for name, seeds in cases:
+        model = _model(name)
+        for seed in seeds:
+            x = model.sample(size=Nsamp, seed=seed)
+            fitted = kde.fit(x)
+            row = {'model': name, 'seed': seed, 'kde': fitted.bandwidth,
+                   'log': kde.kde(x, precision='log')[0],
+                   'warm_below': kde.kde(
+                       x, initial_guess=fitted.t_star/100)[0],
+                   'warm_at': kde.kde(x, initial_guess=fitted.t_star)[0],
+                   'many': kde.kde_many([x])[0][0],
+                   'select': kde.select_bandwidths(
+                       x, methods=('diffusion',))['diffusion']}
+            bandwidths = [row[key] for key in _ROOT_METHODS]
+            row['spread'] = (max(bandwidths) - min(bandwidths))/row['kde']
+            row['agree'] = row['spread'] <= rtol
+            results.append(row)
+    return results
+
+_STAGES = ('histogram', 'dct', 'solve', 'idct', 'normalize')
+
+_models = {}
+def _model(name):
+    """
+    One instance of each dgp_class density per process
+    """
+    if name not in _models:
+        _models[name] = getattr(dgp, name)()
+    return _models[name]
+
+def _staged_kde(x, N):
+    """
+    kde.fit with a KDEStats, returning the wall time of each stage, the
+    number of fixed point evaluations, the bandwidth, and mesh and density.
+    """
+    stats = kde.KDEStats()
+    fitted = kde.fit(x, N, stats=stats)
+    times = dict((stage, stats.times.get(stage, 0)) for stage in _STAGES)
+    if fitted is None:
+        return times, stats.fixed_point_calls, np.nan, None, None
+    return (times, fitted.fixed_point_calls, fitted.bandwidth, fitted.mesh,
+            fitted.density)
+
+def _table1_replication(task):
+    """
+    One Monte Carlo replication, run in a worker process. Each replication
+    has its own seed, so results do not depend on how tasks are scheduled.
+    """
+    name, Nsamp, N, rep, seed = task
+    np.random.seed(seed)
+    model = _model(name)
+    x = np.asarray(model.sample(size=Nsamp))
+    times, calls, bandwidth, mesh, density = _staged_kde(x, N)
+    row = {'model': name, 'Nsamp': Nsamp, 'N': N, 'rep': rep, 'seed': seed,
+           'bandwidth': bandwidth, 'fixed_point_calls': calls,
+           'ise': np.nan if mesh is None else ise(model, mesh, density),
+           'exact_mise': model.exact_mise(bandwidth, Nsamp),
+           'oracle_bandwidth': model.oracle_bandwidth(Nsamp),
+           'time_total': sum(times.values())}
+    for stage in _STAGES:
+        row['time_' + stage] = times[stage]
+    return row
+
+def bench_table1(sizes=(2**14,), Nsamps=(1000, 10000), reps=100, seed=0,
+                 processes=None):
+    """
+    Monte Carlo reproduction of Table 1 of Botev et al. on the dgp_class
+    test densities.
+
+    Parameters
+    ----------
+    sizes: list of ints
+           Mesh sizes N
+    Nsamps: list of ints
+            Sample sizes
+    reps: int
+          Number of replications per (model, Nsamp, N)
+    seed: int
+          Seeds the per replication seeds, so a run is reproducible
+    processes: int, optional
+               Size of the process pool, default the number of CPUs
+
+    Returns
+    -------
+    List of dicts, one per replication, with the wall time of each stage of
+    kde.kde, the number of fixed point evaluations, the bandwidth, the ISE
+    against model.pdf(mesh), and the exact MISE of the bandwidth next to
+    the oracle bandwidth of the model.
+    """
+    names = [name for name, model in _test_models()]
+    tasks = [(name, Nsamp, N, rep) for name in names for Nsamp in Nsamps
+             for N in sizes for rep in xrange(reps)]
+    seeds = np.random.RandomState(seed).randint(2**31 - 1, size=len(tasks))
+    tasks = [task + (int(s),) for task, s in zip(tasks, seeds)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_table1_replication, tasks, chunksize=reps)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def write_json(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+def write_csv(results, path):
+    fields = sorted(results[0])
+    with open(path, 'wb') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+def _print_table1(args):
+    results = bench_table1(reps=args.reps, seed=args.seed,
+                           processes=args.processes)
+    write_json(results, args.output + '.json')
+    write_csv(results, args.output + '.csv')
+    print '%18s %8s %8s %12s %10s %8s' % ('model', 'Nsamp', 'N', 'mean ISE',
+                                          'time (s)', 'calls')
+    keys = sorted(set((r['model'], r['Nsamp'], r['N']) for r in results))
+    for key in keys:
+        rows = [r for r in results if (r['model'], r['Nsamp'], r['N']) == key]
+        print '%18s %8d %8d %12.4g %10.4f %8.1f' % (
+            key + (np.mean([r['ise'] for r in rows]),
+                   np.mean([r['time_total'] for r in rows]),
+                   np.mean([r['fixed_point_calls'] for r in rows])))
+
+def _print_fixed_point(args):
+    results = bench_fixed_point()
+    print '%8s %12s %12s %12s %22s' % ('N', 'method', 'call (s)', 'solve (s)',
+                                       't_star')
+    for row in results:
+        print ('%(N)8d %(method)12s %(call)12.5f %(solve)12.5f '
+               '%(t_star)22.16g' % row)
+
+def _print_binning(args):
+    results = bench_binning()
+    print '%18s %8s %8s %12s %10s' % ('model', 'N', 'binning', 'mean ISE',
+                                      'time (s)')
+    for row in results:
+        print '%(model)18s %(N)8d %(binning)8s %(ise)12.4g %(time)10.4f' % row
+
+def _print_kde2d(args):
+    results = bench_kde2d()
+    print '%18s %8s %12s %10s' % ('model', 'N', 'mean ISE', 'time (s)')
+    for row in results:
+        print '%(model)18s %(N)8d %(ise)12.4g %(time)10.4f' % row
+
+def _print_exact(args):
+    results = bench_exact()
+    print '%18s %12s %12s %12s %10s %10s' % ('model', 'max diff',
+                                             'ISE exact', 'ISE grid',
+                                             'exact (s)', 'grid (s)')
+    for row in results:
+        print ('%(model)18s %(max_diff)12.4g %(ise_exact)12.4g '
+               '%(ise_grid)12.4g %(time_exact)10.4f %(time_grid)10.4f' % row)
+
+def _print_layouts(args):
+    results = bench_layouts()
+    print '%10s %10s %12s %10s  %s' % ('data', 'weights', 'max diff',
+                                       'time (s)', 'error')
+    for row in results:
+        print ('%(data)10s %(weights)10s %(max_diff)12.4g %(time)10.4f  '
+               '%(error)s' % row)
+
+def _print_roots(args):
+    results = bench_roots()
+    print '%18s %6s' % ('model', 'seed') + ''.join(
+        '%11s' % key for key in _ROOT_METHODS) + '%10s' % 'agree'
+    for row in results:
+        print '%18s %6d' % (row['model'], row['seed']) + ''.join(
+            '%11.4f' % row[key] for key in _ROOT_METHODS) + '%10s' % (
+            row['agree'])
+
+_BENCHMARKS = {'fixed_point': _print_fixed_point,
+               'roots': _print_roots,
+               'layouts': _print_layouts,
+               'exact': _print_exact,
+               'binning': _print_binning,
+               'kde2d': _print_kde2d,
+               'table1': _print_table1}
+
+def main(argv=None):
+    """
+    Runs the benchmarks named in argv, or all of them, and prints a table
+    for each.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run, from %s, default all' %
+                        ', '.join(sorted(_BENCHMARKS)))
+    parser.add_argument('--output', default='table1',
+                        help='prefix of the table1 .json and .csv files')
+    parser.add_argument('--reps', type=int, default=100,
+                        help='table1 replications per case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in _BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+    for name in args.names or sorted(_BENCHMARKS):
+        print name
+        _BENCHMARKS[name](args)
+    return None
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+    sys.exit(0)
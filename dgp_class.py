@@ -11,8 +11,12 @@ Daniel B. Smith, PhD
 
 from __future__ import division
 
+import collections
+import multiprocessing
 import numpy as np
-from random import shuffle
+import scipy.optimize
+from scipy.special import ndtr, ndtri
+from seeding import random_state
 
 rand = np.random
 
@@ -22,6 +26,8 @@ Parameters:
 ----------
 size: d1, ..., dn : `n` ints, optional
       The dimensions of the returned array, should be all positive.
+seed: None, int or numpy.random.RandomState, optional
+      Source of randomness. None uses the global numpy.random state.
 
 {eq}
 """
@@ -33,11 +39,21 @@ _pdf_doc = """Calculated probability distribution function according to a
 """
 
 _class_doc = """{class_} class to generate data generating function objects.
-    Each object has two methods:
+    Each object has the methods:
 
     dgp.sample(size=1): generates array of samples according to shape defined 
                         in size.
+    dgp.sample_chunks(n, chunk_size, seed): generates n samples as a
+                        stream of arrays of chunk_size samples
+    dgp.sample_chunks_parallel(n, chunk_size, seed): the same stream
+                        generated on a process pool
     dgp.pdf(mesh):      calculates pdf on the given mesh
+    dgp.logpdf(mesh):   calculates the log of the pdf on the given mesh
+    dgp.cdf(mesh):      calculates cdf on the given mesh
+    dgp.ppf(q):         calculates the quantiles q, the inverse of the cdf
+    dgp.exact_mise(h, n): MISE of a Gaussian kde with bandwidth h from n
+                        samples
+    dgp.oracle_bandwidth(n): the bandwidth minimizing exact_mise
 
     Probability distribution function, N(mu, sigma^2) normal:
       {eq}
@@ -45,53 +61,227 @@ _class_doc = """{class_} class to generate data generating function objects.
 
 # Adapted from scipy:
 _NORM_PDF_C = np.sqrt(2*np.pi)
-def _norm(x, params):
-    x = np.asarray(x)
-    return np.exp(-(x-params[0])**2/2.0/params[1]**2) / _NORM_PDF_C / params[1]
 
-def _generate(inputs, counts):
+# Number of (point, component) pairs evaluated at a time
+_BLOCK = 2**20
+
+def _generate(inputs, rates, nsamp, state, blocksize=2**20):
     """
-    Generates random samples from a sum of normals based on inputs, counts
+    Generates random samples from a sum of normals based on inputs, rates
+
+    The component of every sample is drawn by inverting the cumulative rates
+    and the normals are scaled in place, a block at a time, so the only
+    allocation the size of the output is the output itself.
 
     Parameters
     ----------
     inputs : list of (mean, standard deviation) tuples
-    counts : list of number of samples to draw from each normal defined in
-             inputs
+    rates : list of weights of each normal defined in inputs
+    nsamp : number of samples
+    state : numpy.random.RandomState
     """
-    out = []
-    for iC, count in enumerate(counts):
-        out.extend(inputs[iC][1]*rand.randn(count)+inputs[iC][0])
-    shuffle(out)
+    inputs = np.asarray(inputs, dtype=float).reshape(-1, 2)
+    cdf = np.cumsum(rates, dtype=float)
+    cdf /= cdf[-1]
+    out = np.empty(nsamp)
+    for start in xrange(0, nsamp, blocksize):
+        block = out[start:start+blocksize]
+        labels = cdf.searchsorted(state.random_sample(len(block)),
+                                  side='right')
+        block[:] = state.standard_normal(len(block))
+        block *= inputs[labels, 1]
+        block += inputs[labels, 0]
     return out
 
+def _chunk_states(n, chunk_size, seed):
+    """
+    The size and RandomState of every chunk of a stream of n samples. The
+    state of chunk i is seeded from (root, i), with root an int drawn from
+    seed unless seed is one, so each chunk can be drawn on its own, in any
+    order or process.
+    """
+    if not isinstance(seed, (int, long)):
+        seed = int(random_state(seed).randint(2**31 - 1))
+    for i, start in enumerate(xrange(0, n, chunk_size)):
+        yield min(chunk_size, n - start), (seed, i)
+
+def _sample_chunk(task):
+    model, size, (root, index) = task
+    return model._sample(size, rand.RandomState([root, index]))
+
+def _chunked(func, x, ncomp):
+    """
+    Applies func to x a block of points at a time, so that the (points,
+    components) temporaries hold at most _BLOCK elements.
+    """
+    x = np.asarray(x, dtype=float)
+    flat = x.reshape(-1)
+    out = np.empty(len(flat))
+    step = max(1, _BLOCK//max(ncomp, 1))
+    for start in xrange(0, len(flat), step):
+        out[start:start+step] = func(flat[start:start+step])
+    return out.reshape(x.shape)
+
 class dgp(object):
     __doc__ = _class_doc.format(class_='Default', eq='N/A')
+    def __init__(self):
+        inputs = np.asarray(self._inputs, dtype=float).reshape(-1, 2)
+        self._means = np.ascontiguousarray(inputs[:, 0])
+        self._sigmas = np.ascontiguousarray(inputs[:, 1])
+        self._weights = np.asarray(self._rates, dtype=float)
+        # Pairwise differences of the means and sums of the variances of
+        # the components, for the convolutions in exact_mise
+        self._mean_diff = self._means[:, None] - self._means[None, :]
+        self._var_sum = self._sigmas[:, None]**2 + self._sigmas[None, :]**2
+        self._weight_prod = self._weights[:, None]*self._weights[None, :]
     def __str__(self):
         # Print first line of documentation
         return self.__doc__.split('\n')[0]
-    def sample(self, size=1):
-        nsamp = np.prod(size)
-        out = self._sample(nsamp)
-        return np.resize(out, size)
+    def sample(self, size=1, seed=None):
+        nsamp = int(np.prod(size))
+        out = self._sample(nsamp, random_state(seed))
+        return out.reshape(size)
+    def sample_chunks(self, n, chunk_size=2**20, seed=None):
+        """
+        Generates n samples as a stream of arrays of chunk_size samples,
+        the last one shorter, so that the samples need not fit in memory.
+
+        Parameters
+        ----------
+        n: int
+           Total number of samples
+        chunk_size: int
+        seed: None, int or numpy.random.RandomState
+              Every chunk has its own RandomState seeded from seed and its
+              index, so the same seed and chunk_size give the same stream
+              as sample_chunks_parallel.
+        """
+        for size, key in _chunk_states(n, chunk_size, seed):
+            yield _sample_chunk((self, size, key))
+    def sample_chunks_parallel(self, n, chunk_size=2**20, seed=None,
+                               processes=None):
+        """
+        sample_chunks with the chunks drawn on a process pool. They are
+        yielded in order, and at most two per process are held ahead of
+        the consumer.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        try:
+            pending = collections.deque()
+            ahead = 2*processes
+            for size, key in _chunk_states(n, chunk_size, seed):
+                pending.append(pool.apply_async(_sample_chunk,
+                                                ((self, size, key),)))
+                if len(pending) >= ahead:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
     def pdf(self, mesh):
         return self._pdf(mesh)
+    def logpdf(self, mesh):
+        return self._logpdf(mesh)
+    def cdf(self, mesh):
+        return self._cdf(mesh)
+    def ppf(self, q):
+        return self._ppf(q)
+    def _z(self, x):
+        return (x[:, None] - self._means)/self._sigmas
     def _pdf(self, mesh):
-        return sum((self._rates[k]*_norm(mesh, input_) for k, input_ in 
-                    enumerate(self._inputs)))
-    def _sample(self, nsamp):
-        counts = rand.multinomial(nsamp, self._rates, size=1)[0]
-        return _generate(self._inputs, counts)
+        scale = self._weights/self._sigmas/_NORM_PDF_C
+        return _chunked(lambda x: np.dot(np.exp(-self._z(x)**2/2), scale),
+                        mesh, len(self._means))
+    def _logpdf(self, mesh):
+        offset = np.log(self._weights/self._sigmas/_NORM_PDF_C)
+        def logpdf(x):
+            terms = offset - self._z(x)**2/2
+            top = terms.max(axis=1)
+            return top + np.log(np.exp(terms - top[:, None]).sum(axis=1))
+        return _chunked(logpdf, mesh, len(self._means))
+    def _cdf(self, mesh):
+        return _chunked(lambda x: np.dot(ndtr(self._z(x)), self._weights),
+                        mesh, len(self._means))
+    def _ppf(self, q, tol=1e-12, maxiter=100):
+        """
+        Newton's method on the cdf, falling back to bisection whenever a
+        step leaves the bracket of the root
+        """
+        def ppf(q):
+            lo = np.ones(len(q))*(self._means - 40*self._sigmas).min()
+            hi = np.ones(len(q))*(self._means + 40*self._sigmas).max()
+            x = np.dot(self._weights, self._means)*np.ones(len(q))
+            for _ in xrange(maxiter):
+                z = self._z(x)
+                F = np.dot(ndtr(z), self._weights) - q
+                f = np.dot(np.exp(-z**2/2), self._weights/self._sigmas)
+                lo = np.where(F < 0, x, lo)
+                hi = np.where(F > 0, x, hi)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    new = x - F/(f/_NORM_PDF_C)
+                outside = ~((new > lo) & (new < hi))
+                new[outside] = (lo[outside] + hi[outside])/2
+                done = abs(new - x) <= tol*(1 + abs(x))
+                x = new
+                if done.all():
+                    break
+            return np.where((q < 0) | (q > 1), np.nan,
+                            np.where(q == 0, -np.inf,
+                                     np.where(q == 1, np.inf, x)))
+        return _chunked(ppf, q, len(self._means))
+    def _sample(self, nsamp, state):
+        return _generate(self._inputs, self._rates, nsamp, state)
+    def _omega(self, a, h):
+        """
+        w^T Omega_a w, where Omega_a[l, l'] is the N(0, a*h^2 + sigma_l^2 +
+        sigma_l'^2) density at mu_l - mu_l', for an array of h
+        """
+        var = a*h[..., None, None]**2 + self._var_sum
+        terms = np.exp(-self._mean_diff**2/2/var)/np.sqrt(var)/_NORM_PDF_C
+        return (terms*self._weight_prod).sum(axis=(-2, -1))
+    def exact_mise(self, h, n):
+        """
+        Exact mean integrated squared error of a Gaussian kernel density
+        estimate with bandwidth h from n samples, from the closed form for
+        normal mixtures of Marron and Wand (1992).
+
+        Parameters
+        ----------
+        h: float or array
+           Bandwidth, the standard deviation of the kernel
+        n: int
+           Number of samples
+        """
+        h = np.asarray(h, dtype=float)
+        return (1/(2*np.sqrt(np.pi)*n*h) + (1 - 1/n)*self._omega(2, h) -
+                2*self._omega(1, h) + self._omega(0, h))
+    def oracle_bandwidth(self, n):
+        """
+        Bandwidth minimizing exact_mise for n samples. A log spaced grid
+        locates the minimum, which is then refined with fminbound.
+        """
+        mean = np.dot(self._weights, self._means)
+        scale = np.sqrt(np.dot(self._weights, self._sigmas**2 +
+                               (self._means - mean)**2))
+        grid = np.log(scale) + np.linspace(-12, 1, 261)
+        i = np.argmin(self.exact_mise(np.exp(grid), n))
+        lo = grid[max(i-1, 0)]
+        hi = grid[min(i+1, len(grid)-1)]
+        best = scipy.optimize.fminbound(
+            lambda logh: self.exact_mise(np.exp(logh), n), lo, hi,
+            xtol=1e-10)
+        return np.exp(best)
     def mesh(self, N=None):
         """
         Generates default mesh
         """
         if N is None:
             N = 2**14
-        maxes = [input_[0]+4*input_[1] for input_ in self._inputs]
-        mins = [input_[0]-4*input_[1] for input_ in self._inputs]
-        min_ = min(mins)
-        max_ = max(maxes)
+        min_ = (self._means-4*self._sigmas).min()
+        max_ = (self._means+4*self._sigmas).max()
         return np.linspace(min_, max_, num=N)
     _inputs = []
     _rates = []
@@ -117,8 +307,9 @@ class StronglySkewed(dgp):
         self.pdf.__func__.__doc__ = _pdf_doc.format(dist='strongly skewed', 
                                                     eq=eq)
         self.__doc__ = _class_doc.format(class_='Strongly Skewed', eq=eq)
-        for k in xrange(8):
-            self._inputs.append((3*((2/3)**k-1), (2/3)**k))
+    _inputs = []
+    for k in xrange(8):
+        _inputs.append((3*((2/3)**k-1), (2/3)**k))
     _rates = [1/8]*8
 
 class KurtoticUnimodal(dgp):
@@ -230,12 +421,29 @@ class LogNormal(dgp):
         dist = 'log normal'
         self.pdf.__func__.__doc__ = _pdf_doc.format(dist=dist, eq=eq)
         self.__doc__ = _class_doc.format(class_='Log Normal', eq=eq)
-    sample = rand.lognormal
+    def _sample(self, nsamp, state):
+        return state.lognormal(size=nsamp)
     def _pdf(self, mesh):
         mesh = np.asarray(mesh)
         if (mesh<=0).any():
             raise ValueError('mesh must be >0')
         return np.exp(-np.log(mesh)**2/2)/mesh/_NORM_PDF_C
+    def _logpdf(self, mesh):
+        mesh = np.asarray(mesh, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log = np.log(mesh)
+            return np.where(mesh > 0, -log**2/2 - log - np.log(_NORM_PDF_C),
+                            -np.inf)
+    def _cdf(self, mesh):
+        mesh = np.asarray(mesh, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(mesh > 0, ndtr(np.log(mesh)), 0)
+    def _ppf(self, q):
+        return np.exp(ndtri(np.asarray(q, dtype=float)))
+    def exact_mise(self, h, n):
+        raise NotImplementedError('the log normal is not a normal mixture')
+    def oracle_bandwidth(self, n):
+        raise NotImplementedError('the log normal is not a normal mixture')
     def mesh(self, N=None):
         if N is None:
             N = 2**14
@@ -0,0 +1,132 @@
+"""
+Bivariate normal mixture test densities for kde.kde2d, in the style of the
+univariate densities in dgp_class.
+
+Daniel B. Smith, PhD
+"""
+
+from __future__ import division
+
+import numpy as np
+from seeding import random_state
+
+_class_doc = """{class_} class to generate bivariate data generating function
+    objects. Each object has three methods:
+
+    dgp2d.sample(size=1, seed=None): generates a (size, 2) array of samples
+    dgp2d.pdf(x, y):                 calculates the pdf at the broadcast
+                                     points (x, y)
+    dgp2d.mesh(N):                   generates default x and y mesh axes
+
+    Probability distribution function, N(mu_x, mu_y, sigma_x^2, sigma_y^2,
+    rho) bivariate normal:
+      {eq}
+    """
+
+def _norm2d(x, y, params):
+    mx, my, sx, sy, rho = params
+    zx = (np.asarray(x) - mx)/sx
+    zy = (np.asarray(y) - my)/sy
+    q = (zx**2 - 2*rho*zx*zy + zy**2)/(1 - rho**2)
+    return np.exp(-q/2)/(2*np.pi*sx*sy*np.sqrt(1 - rho**2))
+
+def _generate2d(inputs, rates, nsamp, state):
+    """
+    Generates random samples from a sum of bivariate normals
+
+    Parameters
+    ----------
+    inputs : list of (mean_x, mean_y, sigma_x, sigma_y, rho) tuples
+    rates : list of weights of each normal defined in inputs
+    nsamp : number of samples
+    state : numpy.random.RandomState
+    """
+    mx, my, sx, sy, rho = np.asarray(inputs, dtype=float).T
+    cdf = np.cumsum(rates, dtype=float)
+    cdf /= cdf[-1]
+    labels = cdf.searchsorted(state.random_sample(nsamp), side='right')
+    out = state.standard_normal((nsamp, 2))
+    out[:, 1] *= np.sqrt(1 - rho[labels]**2)
+    out[:, 1] += rho[labels]*out[:, 0]
+    out[:, 0] *= sx[labels]
+    out[:, 0] += mx[labels]
+    out[:, 1] *= sy[labels]
+    out[:, 1] += my[labels]
+    return out
+
+class dgp2d(object):
+    __doc__ = _class_doc.format(class_='Default', eq='N/A')
+    def __str__(self):
+        # Print first line of documentation
+        return self.__doc__.split('\n')[0]
+    def sample(self, size=1, seed=None):
+        return _generate2d(self._inputs, self._rates, size,
+                           random_state(seed))
+    def pdf(self, x, y):
+        return sum((self._rates[k]*_norm2d(x, y, input_) for k, input_ in
+                    enumerate(self._inputs)))
+    def mesh(self, N=None):
+        """
+        Generates default x and y mesh axes
+        """
+        if N is None:
+            N = 2**8
+        axes = []
+        for mean, sigma in ((0, 2), (1, 3)):
+            min_ = min(input_[mean]-4*input_[sigma] for input_ in self._inputs)
+            max_ = max(input_[mean]+4*input_[sigma] for input_ in self._inputs)
+            axes.append(np.linspace(min_, max_, num=N))
+        return tuple(axes)
+    _inputs = []
+    _rates = []
+
+class UncorrelatedNormal(dgp2d):
+    __doc__ = _class_doc.format(class_='Uncorrelated Normal',
+                                eq='N(0, 0, 1, (2/3)^2, 0)')
+    _inputs = [(0, 0, 1, 2/3, 0)]
+    _rates = [1]
+
+class CorrelatedNormal(dgp2d):
+    __doc__ = _class_doc.format(class_='Correlated Normal',
+                                eq='N(0, 0, 1, 1, 7/10)')
+    _inputs = [(0, 0, 1, 1, 7/10)]
+    _rates = [1]
+
+class Kurtotic2D(dgp2d):
+    __doc__ = _class_doc.format(class_='Kurtotic',
+                                eq='2/3*N(0, 0, 1, 2, 1/2) + '
+                                   '1/3*N(0, 0, 2/3, 1/3, -1/2)')
+    _inputs = [(0, 0, 1, 2, 1/2), (0, 0, 2/3, 1/3, -1/2)]
+    _rates = [2/3, 1/3]
+
+class Bimodal2D(dgp2d):
+    __doc__ = _class_doc.format(class_='Bimodal',
+                                eq='1/2*N(-1, 0, 2/3, 2/3, 0) + '
+                                   '1/2*N(1, 0, 2/3, 2/3, 0)')
+    _inputs = [(-1, 0, 2/3, 2/3, 0), (1, 0, 2/3, 2/3, 0)]
+    _rates = [1/2]*2
+
+class SeparatedBimodal2D(dgp2d):
+    __doc__ = _class_doc.format(class_='Separated Bimodal',
+                                eq='1/2*N(-3/2, -3/2, 1/4, 1/4, 0) + '
+                                   '1/2*N(3/2, 3/2, 1/4, 1/4, 0)')
+    _inputs = [(-3/2, -3/2, 1/4, 1/4, 0), (3/2, 3/2, 1/4, 1/4, 0)]
+    _rates = [1/2]*2
+
+class Trimodal2D(dgp2d):
+    __doc__ = _class_doc.format(class_='Trimodal',
+                                eq='9/20*N(-6/5, 6/5, 3/5, 3/5, 3/10) + '
+                                   '9/20*N(6/5, -6/5, 3/5, 3/5, -3/5)\n'
+                                   '      + 1/10*N(0, 0, 1/4, 1/4, 1/5)')
+    _inputs = [(-6/5, 6/5, 3/5, 3/5, 3/10), (6/5, -6/5, 3/5, 3/5, -3/5),
+               (0, 0, 1/4, 1/4, 1/5)]
+    _rates = [9/20, 9/20, 1/10]
+
+class Claw2D(dgp2d):
+    __doc__ = _class_doc.format(class_='Claw',
+                                eq='1/2*N(0, 0, 1, 1, 0) + sum_{k=0}^4 '
+                                   '1/10*N(k/2-1, k/2-1, 1/10, 1/10, 0)')
+    _inputs = [(0, 0, 1, 1, 0)]
+    for k in xrange(5):
+        _inputs.append((k/2-1, k/2-1, 1/10, 1/10, 0))
+    _rates = [1/2] + [1/10]*5
@@ -12,50 +12,1578 @@ Updated 1-23-2013
 
 from __future__ import division
 
+import os
+import hashlib
+import multiprocessing
+import itertools
+import tempfile
+import timeit
+import threading
+import collections
 import scipy as sci
 import scipy.optimize
 import scipy.fftpack
+from seeding import random_state
+try:
+    import scipy.fft as _fft
+except ImportError:
+    # scipy < 1.4 only has the single threaded fftpack
+    _fft = None
 
-def kde(data, N=None, MIN=None, MAX=None):
+def kde(data, N=None, MIN=None, MAX=None, precision='float128',
+        chunksize=2**20, binning='simple', cache=None, initial_guess=None,
+        weights=None, M=None, stats=None):
+    """
+    Kernel density estimate with the bandwidth selected by the diffusion
+    method of Botev et al.
+
+    Parameters
+    ----------
+    data: array, numpy.memmap, path to a .npy file or iterable of arrays
+          The samples. Arrays and files are read `chunksize` values at a
+          time, so memory mapped data is never loaded in full. A list or
+          tuple of arrays is read as chunks as they are. Any other iterable
+          of chunks is consumed once, so MIN and MAX must be given with it.
+    N: int or 'auto'
+       Number of mesh points, rounded up to a power of two. 'auto' solves
+       on a coarse mesh first and then uses the smallest mesh with enough
+       points per bandwidth, see _estimate_auto. The chosen N is the length
+       of the mesh.
+    MIN, MAX: float, optional
+              Limits of the mesh. Default to the range of the data padded
+              by 10%.
+    precision: 'float128' or 'log'
+               See FixedPointSolver.
+    chunksize: int
+               Number of values histogrammed at a time.
+    binning: 'simple' or 'linear'
+             'simple' counts each sample in the bin it falls in. 'linear'
+             splits each sample between the two nearest mesh points in
+             proportion to its distance from them, which has a much smaller
+             binning error, so a coarser N gives the same accuracy.
+    cache: BandwidthCache, optional
+           Reuses the bandwidth, and optionally the density, of earlier
+           calls with the same histogram.
+    initial_guess: float, optional
+                   t_star of an earlier fit to similar data, (bandwidth/
+                   (MAX-MIN))**2. The root search starts from half of it
+                   instead of from zero, see FixedPointSolver.solve.
+    weights: array or iterable of arrays, optional
+             Weight of each sample, in the same layout as data: an array,
+             or a list, tuple or iterable of arrays with the lengths of the
+             chunks of data. Weights are taken to be frequencies, so a
+             (value, count) table can be passed as data=values,
+             weights=counts.
+    M: float, optional
+       Sample size used in the bandwidth selection. Defaults to the number
+       of samples, or to the sum of the weights. Weights that are not counts
+       should pass the effective sample size, see effective_sample_size.
+    stats: KDEStats, optional
+           Filled in with the time, sizes and solver state of each stage.
+
+    Returns
+    -------
+    bandwidth, mesh, density, or None if the bandwidth cannot be found.
+    """
+    return _as_tuple(fit(data, N, MIN, MAX, precision, chunksize, binning,
+                         cache, initial_guess, weights, M, stats))
+
+def fit(data, N=None, MIN=None, MAX=None, precision='float128',
+        chunksize=2**20, binning='simple', cache=None, initial_guess=None,
+        weights=None, M=None, stats=None):
+    """
+    kde returning a FittedKDE, or None if the bandwidth cannot be found.
+    Takes the same parameters as kde.
+    """
+    auto = isinstance(N, str) and N == 'auto'
+    with _stage(stats, 'histogram'):
+        DataHist, total, MIN, MAX = _bin(data, _AUTO_N[1] if auto else N,
+                                         MIN, MAX, chunksize, binning,
+                                         weights)
+        DataHist = DataHist/total
+    M = total if M is None else M
+    if stats is not None:
+        stats.allocated('histogram', DataHist)
+    if auto:
+        fitted = _estimate_auto(DataHist, M, MIN, MAX, precision, cache,
+                                initial_guess, stats, binning)
+    else:
+        fitted = _estimate(DataHist, M, MIN, MAX, precision, cache,
+                           initial_guess, stats)
+    if stats is not None:
+        stats.finish()
+    return fitted
+
+def _bin(data, N, MIN, MAX, chunksize=2**20, binning='simple', weights=None):
+    """
+    The binning stage of kde. Returns the counts, the number of samples or
+    total weight, and MIN and MAX.
+    """
 
     # Parameters to set up the mesh on which to calculate
+    if isinstance(N, str):
+        raise ValueError("N='auto' is only supported by kde and fit")
     N = 2**14 if N is None else int(2**sci.ceil(sci.log2(N)))
+    if binning not in _BINNING:
+        raise ValueError("binning must be 'simple' or 'linear'")
+    data = _as_data(data)
     if MIN is None or MAX is None:
-        minimum = min(data)
-        maximum = max(data)
+        if not isinstance(data, (sci.ndarray, list, tuple)):
+            raise ValueError('MIN and MAX are required when data is an '
+                             'iterable of chunks')
+        minimum, maximum = _data_range(data, chunksize)
         Range = maximum - minimum
         MIN = minimum - Range/10 if MIN is None else MIN
         MAX = maximum + Range/10 if MAX is None else MAX
 
-    # Range of the data
+    # Histogram the data to get a crude first approximation of the density
+    if weights is not None:
+        weights = _iter_chunks(_as_data(weights), chunksize)
+    counts, total = _histogram_chunks(_iter_chunks(data, chunksize), N, MIN,
+                                      MAX, binning, weights)
+    return counts, total, MIN, MAX
+
+def kde_from_counts(counts, MIN, MAX, M=None, precision='float128',
+                    cache=None, initial_guess=None, stats=None):
+    """
+    kde from an existing histogram, skipping the binning stage.
+
+    Parameters
+    ----------
+    counts: array
+            Counts of N equal width bins spanning [MIN, MAX]. N need not be
+            a power of two, but the DCTs are fastest when it is.
+    MIN, MAX: float
+              Edges of the first and last bins
+    M: float, optional
+       Sample size used in the bandwidth selection, by default the sum of
+       the counts
+    precision, cache, initial_guess, stats:
+       See kde.
+
+    Returns
+    -------
+    bandwidth, mesh, density, or None if the bandwidth cannot be found.
+    """
+    counts = sci.asarray(counts, dtype=float).reshape(-1)
+    total = counts.sum()
+    if total <= 0:
+        raise ValueError('counts must have a positive sum')
+    M = total if M is None else M
+    fitted = _estimate(counts/total, M, MIN, MAX, precision, cache,
+                       initial_guess, stats)
+    if stats is not None:
+        stats.finish()
+    return _as_tuple(fitted)
+
+def bootstrap_bands(data, n_boot=200, level=0.95, N=None, MIN=None, MAX=None,
+                    precision='log', chunksize=2**20, binning='simple',
+                    seed=None, processes=None):
+    """
+    Pointwise percentile bootstrap confidence bands of the kde density.
+
+    The data is binned once. Each bootstrap sample is then drawn as a
+    multinomial over the bins, which is equivalent to resampling the data
+    for simple binning, so the cost does not depend on the sample size. The
+    DCTs and IDCTs of all replicates are taken together and the bandwidth
+    solves are spread over a process pool.
+
+    Parameters
+    ----------
+    data, N, MIN, MAX, precision, chunksize, binning:
+        See kde, except that N must be an int. The log precision is the
+        default here as every replicate needs its own solve.
+    n_boot: int
+            Number of bootstrap replicates
+    level: float
+           Coverage of the bands
+    seed: None, int or numpy.random.RandomState
+    processes: int, optional
+               Size of the process pool, default the number of CPUs. 1 solves
+               in this process.
+
+    Returns
+    -------
+    mesh, lower, upper
+    """
+    counts, M, MIN, MAX = _bin(data, N, MIN, MAX, chunksize, binning)
+    N = len(counts)
     R = MAX-MIN
+    state = random_state(seed)
+    # Samples outside [MIN, MAX] are resampled too: they count towards M
+    # without being binned, as in kde
+    outside = max(M - counts.sum(), 0)
+    p = sci.append(counts, outside)/(counts.sum() + outside)
+    DataHist = state.multinomial(M, p, size=n_boot)[:, :N]/M
+    DCTData = _dct(DataHist, axis=1)
+    SqDCTData = (DCTData[:, 1:]/2)**2
 
-    # Histogram the data to get a crude first approximation of the density
-    M = len(data)
-    DataHist, bins = sci.histogram(data, bins=N, range=(MIN,MAX))
-    DataHist = DataHist/M
-    DCTData = scipy.fftpack.dct(DataHist, norm=None)
+    tasks = [(M, a2, precision) for a2 in SqDCTData]
+    if processes == 1:
+        t_star = map(_solve_t_star, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            t_star = pool.map(_solve_t_star, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    t_star = sci.array(t_star)
+    keep = sci.isfinite(t_star)
 
-    I = [iN*iN for iN in xrange(1, N)]
-    SqDCTData = (DCTData[1:]/2)**2
+    k2 = sci.arange(N)**2*sci.pi**2/2
+    SmDCTData = DCTData[keep]*sci.exp(-k2*t_star[keep, None])*N/R
+    density = _idct(SmDCTData, axis=1, overwrite_x=True)
+    mesh = MIN + (sci.arange(N) + 0.5)*R/N
+    density /= sci.trapz(density, mesh, axis=1)[:, None]
+    alpha = (1 - level)/2
+    lower, upper = sci.percentile(density, [100*alpha, 100*(1-alpha)],
+                                  axis=0)
+    return mesh, lower, upper
 
-    # The fixed point calculation finds the bandwidth = t_star
-    guess = 0.1
+def _solve_t_star(task):
+    """
+    t_star of one bootstrap replicate, nan if it cannot be bracketed
+    """
+    M, a2, precision = task
     try:
-        t_star = scipy.optimize.brentq(fixed_point, 0, guess, 
-                                       args=(M, I, SqDCTData))
+        return FixedPointSolver(M, a2, precision).solve()
     except ValueError:
-        print 'Oops!'
+        return sci.nan
+
+def effective_sample_size(weights):
+    """
+    Kish's effective sample size (sum w)^2/sum w^2, for the M of kde with
+    weights that are not frequencies
+    """
+    weights = sci.asarray(weights, dtype=float)
+    return weights.sum()**2/sci.dot(weights.ravel(), weights.ravel())
+
+def select_bandwidths(data, methods=('diffusion', 'silverman',
+                                     'sheather_jones', 'lscv'),
+                      N=None, MIN=None, MAX=None, precision='float128',
+                      chunksize=2**20, binning='simple', weights=None,
+                      densities=False):
+    """
+    Bandwidths of several selectors from a single binning and DCT of the
+    data.
+
+    Every selector works from the histogram and its squared DCT
+    coefficients a2, in which the density functionals the plug-in and
+    cross-validation selectors need are closed form sums, see _functional.
+
+    Parameters
+    ----------
+    data, N, MIN, MAX, precision, chunksize, binning, weights:
+        See kde, except that N must be an int.
+    methods: list of str
+             From 'diffusion', the selector of kde, 'silverman', Silverman's
+             rule of thumb, 'sheather_jones', the Sheather-Jones solve-the-
+             equation plug-in, and 'lscv', least-squares cross-validation.
+    densities: bool
+               Also return the density of each bandwidth on the mesh,
+               smoothed as in kde
+
+    Returns
+    -------
+    dict of the bandwidth of each method, nan where it cannot be found.
+    With densities, (bandwidths, mesh, dict of densities).
+    """
+    for method in methods:
+        if method not in _SELECTORS:
+            raise ValueError('unknown method %s, expected one of %s' %
+                             (method, ', '.join(sorted(_SELECTORS))))
+    counts, M, MIN, MAX = _bin(data, N, MIN, MAX, chunksize, binning,
+                               weights)
+    N = len(counts)
+    R = MAX-MIN
+    DataHist = counts/M
+    DCTData = _dct(DataHist)
+    SqDCTData = (DCTData[1:]/2)**2
+    bandwidths = collections.OrderedDict()
+    for method in methods:
+        try:
+            h = _SELECTORS[method](DataHist, M, SqDCTData, precision)
+        except ValueError:
+            h = sci.nan
+        bandwidths[method] = h*R
+    if not densities:
+        return bandwidths
+
+    t = (sci.array(bandwidths.values())/R)**2
+    SmDCTData = DCTData*sci.exp(-sci.arange(N)**2*sci.pi**2/2*t[:, None])
+    density = _idct(SmDCTData, axis=1, overwrite_x=True)*N/R
+    mesh = MIN + (sci.arange(N) + 0.5)*R/N
+    density /= sci.trapz(density, mesh, axis=1)[:, None]
+    return bandwidths, mesh, dict(zip(bandwidths, density))
+
+def _functional(s, t, a2):
+    """
+    The integral of the square of the s-th derivative of the histogram
+    density on the unit interval smoothed by a Gaussian of variance t, in
+    terms of the squared DCT coefficients a2. This is the sum of
+    fixed_point, so it is (-1)**s*psi_2s(sqrt(2*t)) in the notation of
+    Sheather and Jones.
+    """
+    k = sci.arange(1, len(a2) + 1, dtype=float)
+    I = k*k
+    f = 2*sci.pi**(2*s)*sci.sum(I**s*a2*sci.exp(-I*sci.pi**2*t))
+    return f + 1 if s == 0 else f
+
+def _diffusion_bandwidth(DataHist, M, a2, precision):
+    return sci.sqrt(FixedPointSolver(M, a2, precision).solve())
+
+def _binned_scale(DataHist):
+    """
+    Standard deviation and interquartile range of the histogram on the unit
+    interval
+    """
+    N = len(DataHist)
+    centres = (sci.arange(N) + 0.5)/N
+    mean = sci.dot(DataHist, centres)
+    sd = sci.sqrt(sci.dot(DataHist, (centres - mean)**2))
+    cumulative = sci.concatenate(([0], sci.cumsum(DataHist)))
+    q1, q3 = sci.interp([0.25*cumulative[-1], 0.75*cumulative[-1]],
+                        cumulative, sci.arange(N + 1)/N)
+    return sd, q3 - q1
+
+def _silverman_bandwidth(DataHist, M, a2, precision):
+    sd, iqr = _binned_scale(DataHist)
+    scale = min(sd, iqr/1.349) if iqr > 0 else sd
+    return 0.9*scale*M**(-1/5)
+
+def _sheather_jones_bandwidth(DataHist, M, a2, precision):
+    """
+    Solve-the-equation plug-in of Sheather and Jones (1991) for the
+    Gaussian kernel, with the pilot bandwidths of their paper
+    """
+    sd, iqr = _binned_scale(DataHist)
+    scale = iqr if iqr > 0 else 1.349*sd
+    a = 0.920*scale*M**(-1/7)
+    b = 0.912*scale*M**(-1/9)
+    ratio = _functional(2, a**2/2, a2)/_functional(3, b**2/2, a2)
+    def func(h):
+        g = 1.357*ratio**(1/7)*h**(5/7)
+        psi4 = _functional(2, g**2/2, a2)
+        return h - (1/(2*sci.sqrt(sci.pi)*M*psi4))**(1/5)
+    start = _silverman_bandwidth(DataHist, M, a2, precision)
+    return scipy.optimize.brentq(func, start/100, start*10)
+
+def _lscv_bandwidth(DataHist, M, a2, precision):
+    """
+    Minimizer of the least-squares cross-validation score of the Gaussian
+    kernel, which for the binned data is
+    F(0, h**2) - 2/(M*(M-1))*(M**2*F(0, h**2/2) - M*phi_h(0)), F the
+    _functional of order 0. A log spaced grid from one bin width to twice
+    Silverman's bandwidth locates the minimum, which fminbound refines.
+    """
+    def score(logh):
+        h = sci.exp(logh)
+        return (_functional(0, h**2, a2) -
+                2/(M*(M-1))*(M**2*_functional(0, h**2/2, a2) -
+                             M/(sci.sqrt(2*sci.pi)*h)))
+    start = _silverman_bandwidth(DataHist, M, a2, precision)
+    grid = sci.linspace(sci.log(1/len(DataHist)), sci.log(2*start), 100)
+    scores = [score(logh) for logh in grid]
+    i = sci.argmin(scores)
+    best = scipy.optimize.fminbound(score, grid[max(i-1, 0)],
+                                    grid[min(i+1, len(grid)-1)], xtol=1e-8)
+    return sci.exp(best)
+
+_SELECTORS = {'diffusion': _diffusion_bandwidth,
+              'silverman': _silverman_bandwidth,
+              'sheather_jones': _sheather_jones_bandwidth,
+              'lscv': _lscv_bandwidth}
+
+def evaluate_exact(data, points, bandwidth=None, tol=1e-8, weights=None,
+                   chunksize=2**20):
+    """
+    The Gaussian kernel density estimate sum_i w_i*phi((x-x_i)/h)/h at the
+    points, without binning, by a one dimensional improved fast Gauss
+    transform.
+
+    The samples are grouped in boxes one bandwidth wide. Each box keeps the
+    first p Taylor coefficients of its kernels about its centre, and a point
+    sums the expansions of the boxes within a cutoff radius of it. With both
+    the cutoff and p chosen from tol, the cost is O(p*(n + m)) for n samples
+    and m points rather than O(n*m).
+
+    Parameters
+    ----------
+    data: array
+          The samples
+    points: array
+            Query points of any shape
+    bandwidth: float, optional
+               Standard deviation of the kernel. Defaults to the bandwidth
+               kde selects for data and weights.
+    tol: float
+         Bound on the absolute error of the density at every point
+    weights: array, optional
+             Weight of each sample, normalized to sum to one. The default
+             bandwidth then takes the effective sample size as M, see
+             effective_sample_size.
+    chunksize: int
+               Number of points evaluated at a time
+
+    Returns
+    -------
+    Array of the shape of points
+    """
+    x = sci.asarray(data, dtype=float).reshape(-1)
+    w = sci.ones(len(x)) if weights is None else sci.asarray(
+        weights, dtype=float).reshape(-1)
+    if bandwidth is None:
+        if weights is None:
+            fitted = fit(x)
+        else:
+            fitted = fit(x, weights=w, M=effective_sample_size(w))
+        if fitted is None:
+            raise ValueError('no bandwidth found for data')
+        bandwidth = fitted.bandwidth
+    h = float(bandwidth)
+    w = w/w.sum()
+    points = sci.asarray(points, dtype=float)
+
+    # Error bounds, in units of the kernel peak 1/(sqrt(2*pi)*h): samples
+    # further than rho bandwidths away contribute less than exp(-rho**2/2)
+    # in total, and the Taylor remainder of exp(dx*dy) for |dx| <= a, |dy|
+    # <= b is below (a*b)**p/p! with the Gaussian factors of each term
+    eps = tol*sci.sqrt(2*sci.pi)*h/2
+    a = 0.5
+    rho = sci.sqrt(2*sci.log(1/min(eps, 0.5)))
+    b = rho + a
+    p = 1
+    term = a*b
+    while term > eps:
+        p += 1
+        term *= a*b/p
+
+    # Box the samples one bandwidth wide and accumulate the coefficients
+    # C[box, k] = sum w*exp(-dx**2/2)*dx**k/k! of each occupied box
+    u = x/h
+    origin = u.min()
+    boxes, index = sci.unique(sci.floor(u - origin).astype(int),
+                              return_inverse=True)
+    dx = u - (origin + boxes[index] + a)
+    coefficients = sci.empty((p, len(boxes)))
+    power = w*sci.exp(-dx**2/2)
+    for k in xrange(p):
+        coefficients[k] = sci.bincount(index, power, minlength=len(boxes))
+        power *= dx/(k + 1)
+
+    # Every point sums the boxes whose centres are within b of it
+    flat = points.reshape(-1)
+    out = sci.empty(len(flat))
+    reach = int(sci.ceil(b))
+    for start in xrange(0, len(flat), chunksize):
+        v = flat[start:start+chunksize]/h - origin
+        home = sci.floor(v).astype(int)
+        total = sci.zeros(len(v))
+        for offset in xrange(-reach, reach + 1):
+            box = home + offset
+            j = sci.minimum(boxes.searchsorted(box), len(boxes) - 1)
+            near = sci.flatnonzero(boxes[j] == box)
+            dy = v[near] - (box[near] + a)
+            inner = abs(dy) <= b
+            near, dy = near[inner], dy[inner]
+            C = coefficients[:, j[near]]
+            series = C[p-1]
+            for k in xrange(p-2, -1, -1):
+                series = series*dy + C[k]
+            total[near] += sci.exp(-dy**2/2)*series
+        out[start:start+chunksize] = total
+    return (out/(sci.sqrt(2*sci.pi)*h)).reshape(points.shape)
+
+def _as_tuple(fitted):
+    """
+    The (bandwidth, mesh, density) returned by kde
+    """
+    if fitted is None:
         return None
+    return fitted.bandwidth, fitted.mesh, fitted.density
+
+def _dct(x, axis=-1, workers=None, overwrite_x=False):
+    """
+    Unnormalized type II DCT, with scipy.fft when it is available
+    """
+    if _fft is None:
+        return scipy.fftpack.dct(x, norm=None, axis=axis,
+                                 overwrite_x=overwrite_x)
+    return _fft.dct(x, norm=None, axis=axis, overwrite_x=overwrite_x,
+                    workers=workers)
+
+def _idct(x, axis=-1, workers=None, overwrite_x=False):
+    """
+    Unnormalized type III DCT, the inverse of _dct up to a factor 2N
+    """
+    if _fft is None:
+        return scipy.fftpack.idct(x, norm=None, axis=axis,
+                                  overwrite_x=overwrite_x)
+    # scipy.fft.idct divides by 2N, its type III dct does not
+    return _fft.dct(x, type=3, norm=None, axis=axis, overwrite_x=overwrite_x,
+                    workers=workers)
+
+def _as_data(data):
+    """
+    Opens .npy paths as memory maps and turns sequences of numbers into
+    arrays. Lists and tuples of arrays, and any other iterable, are left
+    alone to be read as a stream of chunks.
+    """
+    if isinstance(data, basestring):
+        return sci.load(data, mmap_mode='r')
+    if isinstance(data, sci.ndarray):
+        return data.reshape(-1)
+    if isinstance(data, (list, tuple)) and any(sci.ndim(x) for x in data):
+        return data
+    if hasattr(data, '__len__'):
+        return sci.asarray(data).reshape(-1)
+    return data
+
+def _iter_chunks(data, chunksize):
+    if isinstance(data, sci.ndarray):
+        for start in xrange(0, len(data), chunksize):
+            yield data[start:start+chunksize]
+    else:
+        for chunk in data:
+            yield sci.asarray(chunk).reshape(-1)
+
+def _data_range(data, chunksize):
+    """
+    Minimum and maximum of data in one chunked pass
+    """
+    minimum = sci.inf
+    maximum = -sci.inf
+    for chunk in _iter_chunks(data, chunksize):
+        if len(chunk):
+            minimum = min(minimum, chunk.min())
+            maximum = max(maximum, chunk.max())
+    if minimum > maximum:
+        raise ValueError('data is empty')
+    return minimum, maximum
+
+def _simple_binning(x, N, MIN, MAX, weights=None):
+    return sci.histogram(x, bins=N, range=(MIN,MAX), weights=weights)[0]
+
+def _linear_binning(x, N, MIN, MAX, weights=None):
+    """
+    Splits each sample in [MIN, MAX] between its two neighbouring mesh
+    points (the bin centres). Samples beyond the outermost mesh points go
+    entirely to them.
+    """
+    inside = (x >= MIN) & (x <= MAX)
+    u = (x[inside] - MIN)*(N/(MAX-MIN)) - 0.5
+    left = sci.floor(u)
+    w = u - left
+    left = left.astype(int)
+    right = 1 - w
+    if weights is not None:
+        weights = weights[inside]
+        w *= weights
+        right *= weights
+    counts = sci.bincount(sci.clip(left, 0, N-1), weights=right, minlength=N)
+    counts += sci.bincount(sci.clip(left+1, 0, N-1), weights=w, minlength=N)
+    return counts
+
+_BINNING = {'simple': (_simple_binning, int),
+            'linear': (_linear_binning, float)}
+
+def _histogram_chunks(chunks, N, MIN, MAX, binning='simple', weights=None):
+    """
+    Sums the N bin histograms on [MIN, MAX] of each chunk into one counts
+    buffer. Returns the counts and the total number, or total weight, of
+    the samples. weights, if given, yields one array per chunk.
+    """
+    binner, dtype = _BINNING[binning]
+    M = 0
+    if weights is None:
+        counts = sci.zeros(N, dtype=dtype)
+        for chunk in chunks:
+            counts += binner(chunk, N, MIN, MAX)
+            M += len(chunk)
+    else:
+        counts = sci.zeros(N)
+        for chunk, w in itertools.izip_longest(chunks, weights):
+            if chunk is None or w is None or len(chunk) != len(w):
+                raise ValueError('weights must have the same layout as data')
+            counts += binner(chunk, N, MIN, MAX, w)
+            M += w.sum()
+    if M == 0:
+        raise ValueError('data is empty')
+    return counts, M
+
+def _estimate(DataHist, M, MIN, MAX, precision='float128', cache=None,
+              initial_guess=None, stats=None):
+    """
+    The stages of kde after binning: DCT, bandwidth selection and IDCT of
+    the normalized histogram DataHist of M samples on [MIN, MAX].
+    """
+    N = len(DataHist)
+    if stats is not None:
+        stats.record(N=N, M=M)
+    t_star = None
+    if cache is not None:
+        with _stage(stats, 'cache'):
+            key = cache.key(DataHist, M, MIN, MAX, precision)
+            hit = cache.get(key)
+        if stats is not None:
+            stats.record(cache_hit=hit is not None)
+        if hit is not None:
+            t_star, coefficients = hit
+            if coefficients is not None:
+                return FittedKDE(t_star, MIN, MAX, M, coefficients)
+    # Range of the data
+    R = MAX-MIN
+    with _stage(stats, 'dct'):
+        DCTData = _dct(DataHist)
+        SqDCTData = (DCTData[1:]/2)**2
+    if stats is not None:
+        stats.allocated('dct', DataHist, DCTData, SqDCTData)
+
+    # The fixed point calculation finds the bandwidth = t_star
+    solver = None
+    with _stage(stats, 'solve'):
+        try:
+            if t_star is None:
+                solver = FixedPointSolver(M, SqDCTData, precision)
+                t_star = solver.solve(initial_guess=initial_guess)
+        except ValueError as e:
+            if stats is not None:
+                stats.record(error=str(e))
+            print 'Oops!'
+            return None
+    if stats is not None and solver is not None:
+        stats.allocated('solve', DCTData, SqDCTData, solver._Ipi2,
+                        *solver._terms.values())
+        stats.record(fixed_point_calls=solver.calls,
+                     brentq_iterations=solver.iterations,
+                     bracket=solver.bracket, residual=solver.residual)
+
+    with _stage(stats, 'idct'):
+        # Smooth the DCTransformed data using t_star
+        SmDCTData = DCTData*sci.exp(-sci.arange(N)**2*sci.pi**2*t_star/2)*N/R
+        # Inverse DCT to get density
+        density = _idct(SmDCTData)
+    if stats is not None:
+        stats.allocated('idct', DCTData, SmDCTData, density)
+
+    with _stage(stats, 'normalize'):
+        mesh = MIN + (sci.arange(N) + 0.5)*R/N
+        norm = sci.trapz(density, mesh)
+        coefficients = SmDCTData/norm
+        density = density/norm
+    if stats is not None:
+        stats.allocated('normalize', SmDCTData, coefficients, density, mesh)
+    if cache is not None:
+        cache.put(key, t_star, coefficients)
+    fitted = FittedKDE(t_star, MIN, MAX, M, coefficients, density)
+    if solver is not None:
+        fitted.fixed_point_calls = solver.calls
+    return fitted
+
+# Coarsest and finest meshes of N='auto', and the mesh points per bandwidth
+# it aims for
+_AUTO_N = (2**10, 2**16)
+_POINTS_PER_BANDWIDTH = 8
+
+def _estimate_auto(DataHist, M, MIN, MAX, precision='float128', cache=None,
+                   initial_guess=None, stats=None, binning='simple'):
+    """
+    _estimate on the smallest mesh resolving the bandwidth.
+
+    DataHist is binned once on the finest mesh, and the coarser histograms
+    are made from it, see _coarsen. t_star is first found on the
+    coarsest mesh. As the bandwidth is sqrt(t_star)*(MAX-MIN) and the mesh
+    step (MAX-MIN)/N, a mesh of _POINTS_PER_BANDWIDTH/sqrt(t_star) points
+    resolves it; the estimate is redone on that mesh, warm started from
+    the coarse t_star, until the mesh is fine enough.
+    """
+    N = min(_AUTO_N[0], len(DataHist))
+    t_star = initial_guess
+    while True:
+        fitted = _estimate(_coarsen(DataHist, N, binning), M, MIN, MAX,
+                           precision, cache, t_star, stats)
+        if fitted is None:
+            return None
+        t_star = fitted.t_star
+        needed = _POINTS_PER_BANDWIDTH/sci.sqrt(t_star)
+        if N >= needed or N == len(DataHist):
+            return fitted
+        N = min(int(2**sci.ceil(sci.log2(needed))), len(DataHist))
+
+def _coarsen(DataHist, N, binning='simple'):
+    """
+    The N bin histogram of the data binned into DataHist, N dividing its
+    length. Simple bins are sums of neighbouring bins. Summing linear bins
+    would give about the simple histogram, so for linear binning the fine
+    bins are themselves linearly binned from their centres, which is within
+    a fine bin width of linearly binning the data.
+    """
+    if N == len(DataHist):
+        return DataHist
+    if binning == 'simple':
+        return DataHist.reshape(N, -1).sum(axis=1)
+    centres = (sci.arange(len(DataHist)) + 0.5)/len(DataHist)
+    return _linear_binning(centres, N, 0, 1, DataHist)
+
+class KDEStats(object):
+    """
+    Opt-in instrumentation of kde, fit and kde_from_counts. Pass an
+    instance as stats= and it is filled in as the stages run; without it
+    the stages are not timed at all.
+
+    Attributes
+    ----------
+    times: OrderedDict
+           Wall time in seconds of each stage that ran, from 'histogram',
+           'cache', 'dct', 'solve', 'idct' and 'normalize'
+    nbytes: OrderedDict
+            Bytes of the arrays each stage holds at once
+    peak_bytes: int
+                Largest of nbytes
+    N, M: int
+          Mesh size and sample size
+    fixed_point_calls, brentq_iterations: int
+        Work done by FixedPointSolver.solve
+    bracket: (float, float)
+             Bracket of t_star handed to brentq
+    residual: float
+              The fixed point equation at t_star
+    cache_hit: bool
+               Whether a BandwidthCache supplied t_star
+    error: str
+           Why the bandwidth could not be found
+
+    Parameters
+    ----------
+    callback: callable, optional
+              Called with the KDEStats when a fit finishes, for example to
+              push as_dict() to a metrics system.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.times = collections.OrderedDict()
+        self.nbytes = collections.OrderedDict()
+        self.peak_bytes = 0
+        self.N = None
+        self.M = None
+        self.fixed_point_calls = None
+        self.brentq_iterations = None
+        self.bracket = None
+        self.residual = None
+        self.cache_hit = None
+        self.error = None
+
+    def stage(self, name):
+        return _Timer(self.times, name)
+
+    def allocated(self, name, *arrays):
+        self.nbytes[name] = sum(a.nbytes for a in arrays)
+        self.peak_bytes = max(self.peak_bytes, self.nbytes[name])
+
+    def record(self, **values):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    def finish(self):
+        if self.callback is not None:
+            self.callback(self)
+
+    def as_dict(self):
+        """
+        The statistics as a flat dict of numbers, with time_<stage> and
+        bytes_<stage> entries. The values are plain Python bools, ints and
+        floats, so the dict can be passed to json.dumps.
+        """
+        out = {'time_total': sum(self.times.values()),
+               'peak_bytes': self.peak_bytes}
+        for name, value in self.times.items():
+            out['time_' + name] = value
+        for name, value in self.nbytes.items():
+            out['bytes_' + name] = value
+        for name in ('N', 'M', 'fixed_point_calls', 'brentq_iterations',
+                     'residual', 'cache_hit'):
+            if getattr(self, name) is not None:
+                out[name] = getattr(self, name)
+        if self.bracket is not None:
+            out['bracket_lo'], out['bracket_hi'] = self.bracket
+        return dict((name, _plain(value)) for name, value in out.items())
+
+def _plain(value):
+    """
+    value as a Python bool, int or float, dropping any numpy scalar type,
+    float128 included
+    """
+    if isinstance(value, (bool, sci.bool_)):
+        return bool(value)
+    if isinstance(value, (int, long, sci.integer)):
+        return int(value)
+    return float(value)
+
+class _Timer(object):
+    """
+    Context manager adding its wall time to times[name]
+    """
+    def __init__(self, times, name):
+        self.times = times
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, *exc_info):
+        elapsed = timeit.default_timer() - self.start
+        self.times[self.name] = self.times.get(self.name, 0) + elapsed
+
+class _NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+def _stage(stats, name):
+    return _NULL_TIMER if stats is None else stats.stage(name)
+
+class BandwidthCache(object):
+    """
+    Bounded LRU cache of the kde bandwidth, keyed on a hash of the binned
+    counts, M, MIN, MAX and the solver precision.
+
+    Parameters
+    ----------
+    maxsize: int, optional
+             Maximum number of entries
+    maxbytes: int, optional
+              Maximum total size of the cached arrays
+    store_density: bool
+                   Also keep the smoothed DCT coefficients, so that a hit
+                   skips the DCT and the bandwidth solve entirely
+    backend: optional
+             Second level store shared with other processes, such as
+             DiskCacheBackend. It needs get(key), returning
+             (t_star, coefficients or None) or None, and set(key, value).
+             Misses in memory are looked up there and every put is
+             written through.
+
+    Attributes
+    ----------
+    hits, misses, evictions: int
+    """
+    def __init__(self, maxsize=128, maxbytes=None, store_density=False,
+                 backend=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.store_density = store_density
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(DataHist, M, MIN, MAX, precision='float128'):
+        digest = hashlib.sha1(sci.ascontiguousarray(DataHist).view(sci.uint8))
+        digest.update(repr((len(DataHist), M, float(MIN), float(MAX),
+                            precision)).encode('ascii'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns (t_star, coefficients or None), or None on a miss
+        """
+        with self._lock:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                self.hits += 1
+                return value
+        value = None if self.backend is None else self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                # The backend may hold coefficients written by a cache that
+                # stores them; this one only keeps t_star unless it does too
+                self._insert(key, value if self.store_density
+                             else (value[0], None))
+        return value
+
+    def put(self, key, t_star, coefficients=None):
+        if not self.store_density:
+            coefficients = None
+        value = (t_star, coefficients)
+        with self._lock:
+            self._insert(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    def _insert(self, key, value):
+        if key in self._entries:
+            self.nbytes -= _nbytes(self._entries.pop(key))
+        self._entries[key] = value
+        self.nbytes += _nbytes(value)
+        while self._entries and (
+                (self.maxsize is not None and
+                 len(self._entries) > self.maxsize) or
+                (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            old = self._entries.popitem(last=False)[1]
+            self.nbytes -= _nbytes(old)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Counters as a dict, for export to a metrics system
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self._entries),
+                    'bytes': self.nbytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+def _nbytes(value):
+    t_star, coefficients = value
+    return 8 + (0 if coefficients is None else coefficients.nbytes)
+
+class DiskCacheBackend(object):
+    """
+    BandwidthCache backend keeping one .npz file per key in a directory, so
+    that it can be shared by worker processes. Files are written to a
+    temporary name and renamed, so readers never see a partial entry.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        try:
+            stored = sci.load(self._path(key))
+        except IOError:
+            return None
+        try:
+            coefficients = stored['coefficients']
+            return (float(stored['t_star']),
+                    coefficients if coefficients.size else None)
+        finally:
+            stored.close()
+
+    def set(self, key, value):
+        t_star, coefficients = value
+        if coefficients is None:
+            coefficients = sci.empty(0)
+        handle, temp = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+        with os.fdopen(handle, 'wb') as f:
+            sci.savez(f, t_star=t_star, coefficients=coefficients)
+        os.rename(temp, self._path(key))
+
+class FittedKDE(object):
+    """
+    A density estimate from kde, kept as arrays on its mesh.
+
+    Attributes
+    ----------
+    t_star: float
+            Selected bandwidth on the unit interval
+    bandwidth: float
+               t_star scaled to the data, sqrt(t_star)*(MAX-MIN)
+    MIN, MAX: float
+              Limits of the mesh
+    N: int
+       Number of mesh points
+    M: int
+       Number of samples
+    coefficients: array
+                  Smoothed DCT coefficients, scaled so that their inverse
+                  DCT is density
+    mesh, density: array
+                   The estimate at the bin centres
+    edges: array
+           The N+1 bin edges, on which cdf, quantile and sample tabulate the
+           CDF
+    fixed_point_calls: int or None
+                       Number of evaluations of the fixed point equation
+                       made to find t_star, None if it came from a cache
+    """
+    def __init__(self, t_star, MIN, MAX, M, coefficients, density=None):
+        self.t_star = t_star
+        self.MIN = MIN
+        self.MAX = MAX
+        self.M = M
+        self.coefficients = coefficients
+        self.N = len(coefficients)
+        self.bandwidth = sci.sqrt(t_star)*(MAX-MIN)
+        self.step = (MAX-MIN)/self.N
+        self.mesh = MIN + (sci.arange(self.N) + 0.5)*self.step
+        if density is None:
+            density = _idct(coefficients)
+        self.density = density
+        self.edges = MIN + sci.arange(self.N + 1)*self.step
+        self.fixed_point_calls = None
+        self._table = None
+
+    def evaluate(self, x, kind='linear', chunksize=2**20):
+        """
+        Density at the points x, interpolated from the mesh.
+
+        Parameters
+        ----------
+        x: array
+           Query points of any shape. The density is zero outside
+           [MIN, MAX].
+        kind: 'linear' or 'cubic'
+              Linear or Catmull-Rom cubic interpolation between mesh points
+        chunksize: int
+                   Number of points interpolated at a time, which bounds the
+                   size of the temporaries
+
+        Returns
+        -------
+        Array of the shape of x
+        """
+        if kind not in ('linear', 'cubic'):
+            raise ValueError("kind must be 'linear' or 'cubic'")
+        x = sci.asarray(x, dtype=float)
+        flat = x.reshape(-1)
+        out = sci.empty(len(flat))
+        for start in xrange(0, len(flat), chunksize):
+            chunk = flat[start:start+chunksize]
+            out[start:start+chunksize] = self._interpolate(chunk, kind)
+        return out.reshape(x.shape)
+
+    __call__ = evaluate
+
+    def logpdf(self, x, kind='linear', chunksize=2**20):
+        """
+        Log of evaluate, -inf where the estimate is not positive.
+        """
+        with sci.errstate(divide='ignore'):
+            return sci.log(sci.maximum(self.evaluate(x, kind, chunksize), 0))
+
+    def compact(self, tol=1e-8):
+        """
+        CompactKDE keeping only the leading coefficients.
+
+        The density is c_0 + 2*sum_k c_k*cos(pi*k*u), so dropping the
+        coefficients from K on changes it by at most 2*sum_{k>=K} |c_k|. K is
+        the smallest cut keeping that bound below tol times the peak of the
+        density.
+        """
+        c = sci.asarray(self.coefficients, dtype=float)
+        tail = 2*sci.cumsum(abs(c)[::-1])[::-1]
+        bound = tol*abs(self.density).max()
+        K = max(int(sci.count_nonzero(tail > bound)), 1)
+        return CompactKDE(self.t_star, self.MIN, self.MAX, self.N, self.M,
+                          c[:K].copy())
+
+    def cdf(self, x):
+        """
+        Cumulative distribution function at the points x, 0 below MIN and 1
+        above MAX. It is exact at the bin edges and linear between them.
+        """
+        return sci.interp(sci.asarray(x, dtype=float), self.edges,
+                          self._cumulative())
+
+    def quantile(self, q):
+        """
+        Inverse of cdf at the probabilities q, nan outside [0, 1].
+        """
+        table = self._cumulative()
+        q = sci.asarray(q, dtype=float)
+        j = sci.clip(table.searchsorted(q, side='right'), 1, self.N)
+        lo = table[j-1]
+        width = table[j] - lo
+        with sci.errstate(divide='ignore', invalid='ignore'):
+            w = sci.where(width > 0, (q - lo)/width, 0)
+        out = self.edges[j-1] + sci.clip(w, 0, 1)*self.step
+        return sci.where((q >= 0) & (q <= 1), out, sci.nan)
+
+    def sample(self, size=1, seed=None):
+        """
+        Draws from the estimate by inverting the cdf.
+
+        Parameters
+        ----------
+        size: int or tuple of ints
+        seed: None, int or numpy.random.RandomState
+        """
+        return self.quantile(random_state(seed).random_sample(size))
+
+    def _cumulative(self):
+        """
+        The CDF at the bin edges. The density is the cosine series
+        c_0 + 2*sum_k c_k*cos(pi*k*u) in u = (x-MIN)/(MAX-MIN), so integrating
+        term by term the CDF at the edge u = j/N is
+        (MAX-MIN)*(c_0*j/N + 2*sum_k c_k*sin(pi*k*j/N)/(pi*k)), and the sum
+        over k at all interior edges is a single DST-I.
+        """
+        if self._table is None:
+            c = sci.asarray(self.coefficients, dtype=float)
+            k = sci.arange(1, self.N)
+            table = sci.empty(self.N + 1)
+            table[0] = 0
+            table[1:-1] = (c[0]*k/self.N +
+                           scipy.fftpack.dst(c[1:]/(sci.pi*k), type=1))
+            table[-1] = c[0]
+            # Ringing can make the estimate slightly negative in the tails
+            table = sci.maximum.accumulate(table)
+            self._table = table/table[-1]
+        return self._table
+
+    def _interpolate(self, x, kind):
+        d = self.density
+        last = self.N - 1
+        u = sci.clip((x - self.mesh[0])/self.step, 0, last)
+        i = sci.minimum(sci.floor(u).astype(int), last - 1)
+        w = u - i
+        if kind == 'linear':
+            y = d[i]*(1 - w) + d[i+1]*w
+        else:
+            p0 = d[sci.maximum(i-1, 0)]
+            p1 = d[i]
+            p2 = d[i+1]
+            p3 = d[sci.minimum(i+2, last)]
+            y = p1 + w*((p2 - p0) + w*((2*p0 - 5*p1 + 4*p2 - p3) +
+                                       w*(3*(p1 - p2) + p3 - p0)))/2
+        y[(x < self.MIN) | (x > self.MAX)] = 0
+        return y
+
+class CompactKDE(object):
+    """
+    A FittedKDE reduced to its leading smoothed DCT coefficients, from
+    FittedKDE.compact. The coefficients decay like exp(-k**2*pi**2*t_star/2),
+    so usually a few hundred of the N are kept.
+
+    to_array packs it into one float array, [MIN, MAX, N, t_star, M,
+    coefficients...], for storing many estimates together; save writes that
+    to a .npy file and load_compact reads it back.
+
+    Attributes
+    ----------
+    t_star, MIN, MAX, N, M:
+        As in FittedKDE
+    coefficients: array
+                  The first coefficients of the FittedKDE
+    """
+    def __init__(self, t_star, MIN, MAX, N, M, coefficients):
+        self.t_star = t_star
+        self.MIN = MIN
+        self.MAX = MAX
+        self.N = N
+        self.M = M
+        self.coefficients = coefficients
+        self.bandwidth = sci.sqrt(t_star)*(MAX-MIN)
+
+    def evaluate(self, x, chunksize=2**20):
+        """
+        Density at the points x from the cosine series of the kept
+        coefficients, zero outside [MIN, MAX].
+
+        Parameters
+        ----------
+        x: array
+           Query points of any shape
+        chunksize: int
+                   Bound on the number of (point, coefficient) terms summed
+                   at a time
+        """
+        x = sci.asarray(x, dtype=float)
+        flat = x.reshape(-1)
+        out = sci.empty(len(flat))
+        c = self.coefficients.copy()
+        c[1:] *= 2
+        k = sci.pi*sci.arange(len(c))
+        step = max(chunksize//len(c), 1)
+        for start in xrange(0, len(flat), step):
+            u = (flat[start:start+step] - self.MIN)/(self.MAX - self.MIN)
+            out[start:start+step] = sci.dot(sci.cos(u[:, None]*k), c)
+        out[(flat < self.MIN) | (flat > self.MAX)] = 0
+        return out.reshape(x.shape)
+
+    __call__ = evaluate
+
+    def expand(self):
+        """
+        FittedKDE on the full mesh of N points
+        """
+        coefficients = sci.zeros(self.N)
+        coefficients[:len(self.coefficients)] = self.coefficients
+        return FittedKDE(self.t_star, self.MIN, self.MAX, self.M,
+                         coefficients)
+
+    def to_array(self):
+        return sci.concatenate(([self.MIN, self.MAX, self.N, self.t_star,
+                                 self.M], self.coefficients))
+
+    @classmethod
+    def from_array(cls, array):
+        MIN, MAX, N, t_star, M = array[:5]
+        return cls(t_star, MIN, MAX, int(N), M,
+                   sci.array(array[5:], dtype=float))
+
+    def save(self, path):
+        sci.save(path, self.to_array())
+
+def load_compact(path):
+    """
+    Reads a CompactKDE written by CompactKDE.save
+    """
+    return CompactKDE.from_array(sci.load(path))
+
+class StreamingKDE(object):
+    """
+    kde over a stream of data on a fixed [MIN, MAX] mesh.
+
+    Only the integer bin counts of the histogram stage of kde are kept, so
+    memory is O(N) however many samples have been seen. estimate() reruns
+    the DCT, bandwidth and IDCT stages on the current counts.
+
+    Parameters
+    ----------
+    MIN, MAX: float
+              Limits of the mesh. Samples outside are counted in M but not
+              binned, as in kde.
+    N: int
+       Number of mesh points, rounded up to a power of two as in kde.
+    window: int, optional
+            Keep only the last `window` chunks passed to update. The counts
+            of each chunk in the window are kept, so memory is O(window*N).
+    precision: 'float128' or 'log'
+               See FixedPointSolver.
+    """
+    def __init__(self, MIN, MAX, N=None, window=None, precision='float128'):
+        self.N = 2**14 if N is None else int(2**sci.ceil(sci.log2(N)))
+        self.MIN = MIN
+        self.MAX = MAX
+        self.window = window
+        self.precision = precision
+        self.counts = sci.zeros(self.N, dtype=int)
+        self.M = 0
+        self.t_star = None
+        self._chunks = collections.deque()
+
+    def _histogram(self, chunk):
+        chunk = sci.asarray(chunk).ravel()
+        counts = sci.histogram(chunk, bins=self.N,
+                               range=(self.MIN, self.MAX))[0]
+        return counts, len(chunk)
+
+    def update(self, chunk):
+        """
+        Adds the samples in chunk, expiring the oldest chunk if the window
+        is full.
+        """
+        counts, M = self._histogram(chunk)
+        self.counts += counts
+        self.M += M
+        if self.window is not None:
+            self._chunks.append((counts, M))
+            while len(self._chunks) > self.window:
+                old_counts, old_M = self._chunks.popleft()
+                self.counts -= old_counts
+                self.M -= old_M
+
+    def remove(self, chunk):
+        """
+        Removes samples previously added with update.
+        """
+        if self.window is not None:
+            raise ValueError('remove cannot be used together with window')
+        counts, M = self._histogram(chunk)
+        if M > self.M or (counts > self.counts).any():
+            raise ValueError('chunk contains samples that were never added')
+        self.counts -= counts
+        self.M -= M
+
+    def estimate(self):
+        """
+        Returns bandwidth, mesh, density for the current counts, or None if
+        the bandwidth cannot be found, as kde. The root search is warm
+        started from the t_star of the previous estimate.
+        """
+        if self.M == 0:
+            raise ValueError('no samples have been added')
+        fitted = _estimate(self.counts/self.M, self.M, self.MIN, self.MAX,
+                           self.precision, initial_guess=self.t_star)
+        if fitted is not None:
+            self.t_star = fitted.t_star
+        return _as_tuple(fitted)
+
+class KDEWorkspace(object):
+    """
+    kde for repeated fits on one (N, MIN, MAX) mesh, with the histogram,
+    DCT, smoothing and density buffers, the mesh and the k^2 tables of the
+    smoothing and of FixedPointSolver allocated once.
+
+    Parameters
+    ----------
+    N: int
+       Number of mesh points, rounded up to a power of two as in kde.
+    MIN, MAX: float
+              Limits of the mesh
+    precision: 'float128' or 'log'
+               See FixedPointSolver.
+    binning: 'simple' or 'linear'
+             See kde.
+    workers: int, optional
+             Number of threads of the DCTs, -1 for all cores. Needs
+             scipy >= 1.4, older versions use the single threaded fftpack.
+    """
+    def __init__(self, N, MIN, MAX, precision='float128', binning='simple',
+                 workers=None):
+        if binning not in _BINNING:
+            raise ValueError("binning must be 'simple' or 'linear'")
+        self.N = N = int(2**sci.ceil(sci.log2(N)))
+        self.MIN = MIN
+        self.MAX = MAX
+        self.precision = precision
+        self.binning = binning
+        self.workers = workers
+        R = MAX-MIN
+        self.mesh = MIN + (sci.arange(N) + 0.5)*R/N
+        self._smoothing = -sci.arange(N)**2*sci.pi**2/2
+        self._powers = FixedPointSolver.power_tables(N, precision)
+        self._terms = dict((s, sci.empty_like(table))
+                           for s, table in self._powers[1].items())
+        self._counts = sci.empty(N)
+        self._hist = sci.empty(N)
+        self._a2 = sci.empty(N-1)
+        self._smooth = sci.empty(N)
+
+    def kde(self, data, chunksize=2**20, initial_guess=None):
+        """
+        kde of data on the workspace mesh.
+
+        Returns bandwidth, mesh, density as arrays, or None if the bandwidth
+        cannot be found. density lives in a buffer of the workspace that the
+        next call overwrites, so copy it to keep it.
+        """
+        N = self.N
+        binner = _BINNING[self.binning][0]
+        self._counts.fill(0)
+        M = 0
+        for chunk in _iter_chunks(_as_data(data), chunksize):
+            self._counts += binner(chunk, N, self.MIN, self.MAX)
+            M += len(chunk)
+        if M == 0:
+            raise ValueError('data is empty')
+        sci.divide(self._counts, M, out=self._hist)
+        DCTData = _dct(self._hist, workers=self.workers)
+
+        sci.multiply(DCTData[1:], 0.5, out=self._a2)
+        sci.square(self._a2, out=self._a2)
+        solver = FixedPointSolver(M, self._a2, self.precision, self._powers,
+                                  self._terms)
+        try:
+            t_star = solver.solve(initial_guess=initial_guess)
+        except ValueError:
+            print 'Oops!'
+            return None
+
+        R = self.MAX-self.MIN
+        sci.multiply(self._smoothing, t_star, out=self._smooth)
+        sci.exp(self._smooth, out=self._smooth)
+        self._smooth *= DCTData
+        self._smooth *= N/R
+        density = _idct(self._smooth, workers=self.workers, overwrite_x=True)
+        density /= sci.trapz(density, self.mesh)
+        return sci.sqrt(t_star)*R, self.mesh, density
+
+def kde_many(data, N=None, MIN=None, MAX=None, keys=None,
+             precision='float128'):
+    """
+    Runs kde on many datasets at once.
+
+    Every group is histogrammed in a single pass, the DCT and IDCT are taken
+    along the mesh axis and the t_star of all groups are found together, so
+    the Python overhead is paid once per call rather than once per group.
+
+    Parameters
+    ----------
+    data: 2-D array, list of 1-D arrays or 1-D array
+          One group per row, one group per list element, or a column of
+          values grouped by `keys`.
+    N: int
+       Number of mesh points, rounded up to a power of two as in kde.
+    MIN, MAX: float or array of floats, optional
+              Mesh limits, either shared by every group or one per group.
+              Defaults to the range of each group padded by 10%.
+    keys: 1-D array, optional
+          Group label of every element of `data`. The rows of the output
+          follow the order of numpy.unique(keys).
+    precision: 'float128' or 'log'
+               See FixedPointSolver.
+
+    Returns
+    -------
+    bandwidth: array of shape (G,)
+    mesh: array of shape (G, N)
+    density: array of shape (G, N)
+    Groups whose bandwidth could not be bracketed are returned as nan.
+    """
+    if precision not in ('float128', 'log'):
+        raise ValueError("precision must be 'float128' or 'log'")
+    N = 2**14 if N is None else int(2**sci.ceil(sci.log2(N)))
+    values, group, M = _group_data(data, keys)
+    G = len(M)
+
+    # Parameters to set up the mesh of every group
+    if MIN is None or MAX is None:
+        starts = sci.concatenate(([0], sci.cumsum(M)[:-1]))
+        minimum = sci.minimum.reduceat(values, starts)
+        maximum = sci.maximum.reduceat(values, starts)
+        Range = maximum - minimum
+        MIN = minimum - Range/10 if MIN is None else MIN
+        MAX = maximum + Range/10 if MAX is None else MAX
+    MIN = sci.ones(G)*MIN
+    MAX = sci.ones(G)*MAX
+    R = MAX-MIN
+
+    # Histogram every group at once, with the same bins as sci.histogram
+    lo = MIN[group]
+    hi = MAX[group]
+    inside = (values >= lo) & (values <= hi)
+    index = ((values[inside] - lo[inside])/R[group[inside]]*N).astype(int)
+    index = sci.minimum(index, N-1) + group[inside]*N
+    DataHist = sci.bincount(index, minlength=G*N).reshape(G, N)
+    DataHist = DataHist/M[:, None]
+    DCTData = _dct(DataHist, axis=1)
+
+    I = sci.arange(1, N, dtype=float)**2
+    SqDCTData = (DCTData[:, 1:]/2)**2
+
+    # Solve for every t_star together, a block of groups at a time to bound
+    # the size of the float128 temporaries
+    if precision == 'log':
+        logI = sci.log(I)
+        with sci.errstate(divide='ignore'):
+            SqDCTData = sci.log(SqDCTData)
+        func = lambda t, M, loga2: _log_fixed_point_many(t, M, logI, loga2)
+    else:
+        func = lambda t, M, a2: _fixed_point_many(t, M, I, a2)
+    t_star = sci.empty(G)
+    block = max(1, 2**20//N)
+    for start in xrange(0, G, block):
+        rows = slice(start, start+block)
+        args = (M[rows], SqDCTData[rows])
+        lo, hi = _bracket_many(func, args)
+        t_star[rows] = _root_many(func, lo, hi, args=args)
 
     # Smooth the DCTransformed data using t_star
-    SmDCTData = DCTData*sci.exp(-sci.arange(N)**2*sci.pi**2*t_star/2)
+    k2 = sci.arange(N)**2*sci.pi**2/2
+    SmDCTData = DCTData*sci.exp(-k2*t_star[:, None])
     # Inverse DCT to get density
-    density = scipy.fftpack.idct(SmDCTData, norm=None)*N/R
-    mesh = [(bins[i]+bins[i+1])/2 for i in xrange(N)]
+    density = _idct(SmDCTData, axis=1)*N/R[:, None]
+    mesh = MIN[:, None] + (sci.arange(N) + 0.5)*(R/N)[:, None]
     bandwidth = sci.sqrt(t_star)*R
-    
-    density = density/sci.trapz(density, mesh)
+
+    density = density/sci.trapz(density, mesh, axis=1)[:, None]
+    return bandwidth, mesh, density
+
+def _group_data(data, keys):
+    """
+    Flattens the input of kde_many into a value array, the group number of
+    each value and the size of each group, with the values sorted by group.
+    """
+    if keys is not None:
+        values = sci.asarray(data, dtype=float).ravel()
+        keys = sci.asarray(keys).ravel()
+        if len(keys) != len(values):
+            raise ValueError('keys and data must have the same length')
+        group = sci.unique(keys, return_inverse=True)[1].ravel()
+        order = sci.argsort(group, kind='mergesort')
+        values = values[order]
+        group = group[order]
+        M = sci.bincount(group)
+    elif isinstance(data, sci.ndarray) and data.ndim == 2:
+        values = sci.asarray(data, dtype=float).ravel()
+        M = sci.repeat(data.shape[1], data.shape[0])
+        group = sci.repeat(sci.arange(data.shape[0]), data.shape[1])
+    else:
+        groups = [sci.asarray(x, dtype=float).ravel() for x in data]
+        M = sci.array([len(x) for x in groups], dtype=int)
+        values = sci.concatenate(groups)
+        group = sci.repeat(sci.arange(len(groups)), M)
+    if len(M) == 0 or (M == 0).any():
+        raise ValueError('every group must contain data')
+    return values, group, M
+
+def kde2d(data, N=None, MIN=None, MAX=None):
+    """
+    Bivariate kde with a bandwidth per axis, following kde2d by Zdravko
+    Botev: a 2-D histogram, a 2-D DCT and a fixed point equation coupling
+    the two bandwidths.
+
+    Parameters
+    ----------
+    data: array of shape (M, 2)
+          The samples, one per row
+    N: int
+       Number of mesh points along each axis, rounded up to a power of two.
+       Defaults to 2**8.
+    MIN, MAX: pairs of floats, optional
+              Corners of the mesh. Default to the range of the data padded
+              by half of it on each side, as in Botev's kde2d.
+
+    Returns
+    -------
+    bandwidth: array of the two bandwidths
+    mesh: tuple of the x and y mesh axes
+    density: array of shape (N, N), density[i, j] at (mesh[0][i], mesh[1][j])
+    or None if the bandwidth cannot be found.
+    """
+    N = 2**8 if N is None else int(2**sci.ceil(sci.log2(N)))
+    data = sci.asarray(data, dtype=float)
+    if data.ndim != 2 or data.shape[1] != 2:
+        raise ValueError('data must have shape (M, 2)')
+    M = len(data)
+    if MIN is None or MAX is None:
+        minimum = data.min(axis=0)
+        maximum = data.max(axis=0)
+        Range = maximum - minimum
+        MIN = minimum - Range/2 if MIN is None else MIN
+        MAX = maximum + Range/2 if MAX is None else MAX
+    MIN = sci.asarray(MIN, dtype=float)
+    MAX = sci.asarray(MAX, dtype=float)
+    R = MAX-MIN
+
+    DataHist = sci.histogram2d(data[:, 0], data[:, 1], bins=N,
+                               range=list(zip(MIN, MAX)))[0]/M
+    DCTData = _dct(_dct(DataHist, axis=0), axis=1)
+
+    try:
+        t_x, t_y = _FixedPoint2D(M, DCTData).solve()
+    except ValueError:
+        print 'Oops!'
+        return None
+
+    # Smooth the DCTransformed data using t_x and t_y
+    k2 = sci.arange(N)**2*sci.pi**2/2
+    SmDCTData = (sci.exp(-k2*t_x)[:, None]*sci.exp(-k2*t_y)[None, :]*
+                 DCTData)
+    density = _idct(_idct(SmDCTData, axis=0), axis=1)/(4*R[0]*R[1])
+    density[density < 0] = sci.finfo(float).eps
+    mesh = tuple(MIN[i] + (sci.arange(N) + 0.5)*R[i]/N for i in xrange(2))
+    bandwidth = sci.sqrt([t_x, t_y])*R
     return bandwidth, mesh, density
 
 def fixed_point(t, M, I, a2):
@@ -70,3 +1598,401 @@ def fixed_point(t, M, I, a2):
         time=(2*const*K0/M/f)**(2/(3+2*s))
         f=2*sci.pi**(2*s)*sci.sum(I**s*a2*sci.exp(-I*sci.pi**2*time))
     return t-(2*M*sci.sqrt(sci.pi)*f)**(-2/5)
+
+class FixedPointSolver(object):
+    """
+    The fixed point equation of fixed_point for a single histogram, with the
+    k^(2s)*a2 power tables and the per-stage constants computed once, so that
+    each evaluation inside brentq only pays for the exponentials and sums.
+
+    Parameters
+    ----------
+    M: int
+       Number of samples in the histogram
+    a2: array
+        Squared DCT coefficients, (DCTData[1:]/2)**2
+    precision: 'float128' or 'log'
+               'float128' matches fixed_point. 'log' works in float64 and
+               evaluates every sum as a log-sum-exp, which avoids overflow
+               without the software emulated extended precision.
+    powers: optional
+            power_tables(len(a2)+1, precision), to reuse across histograms
+            with the same N. They are used as they are, without copies,
+            unless a2 has zeros and terms is not given.
+    terms: dict of arrays, optional
+           Buffers shaped and typed like the tables of powers, that the
+           per-histogram products of the tables and a2 are written into,
+           so that repeated solves allocate nothing of size N. Needs
+           powers.
+    """
+    l = 7
+
+    def __init__(self, M, a2, precision='float128', powers=None,
+                 terms=None):
+        if precision not in ('float128', 'log'):
+            raise ValueError("precision must be 'float128' or 'log'")
+        self.precision = precision
+        a2 = sci.asarray(a2, dtype=float)
+        # Empty bins of the DCT contribute nothing to any of the sums, so
+        # they are dropped, unless the tables can then be used without
+        # copying them: zeros add nothing to the float128 sums and -inf
+        # nothing to the log-sum-exps
+        nonzero = sci.flatnonzero(a2)
+        if powers is None:
+            a2 = a2[nonzero]
+            Ipi2, tables = self._power_tables(nonzero + 1.0, precision)
+        elif terms is not None or len(nonzero) == len(a2):
+            Ipi2, tables = powers
+        else:
+            a2 = a2[nonzero]
+            Ipi2 = powers[0][nonzero]
+            tables = dict((s, table[nonzero])
+                          for s, table in powers[1].items())
+        stages = range(self.l, 1, -1)
+        K0 = [sci.prod(sci.arange(1, 2*s, 2, dtype=float))/sci.sqrt(2*sci.pi)
+              for s in stages]
+        const = [(1 + (1/2)**(s + 1/2))/3 for s in stages]
+        # time_s = (c_s/f_(s+1))**p_s
+        self._c = [2*const[i]*K0[i]/M for i in xrange(len(stages))]
+        self._p = [2/(3+2*s) for s in stages]
+        self._M = M
+        self.calls = 0
+        self.iterations = 0
+        self.bracket = None
+        self.residual = None
+        self._Ipi2 = Ipi2
+        if terms is None:
+            terms = dict((s, None) for s in tables)
+        if precision == 'float128':
+            self._terms = dict((s, sci.multiply(table, a2, out=terms[s]))
+                               for s, table in tables.items())
+        else:
+            with sci.errstate(divide='ignore'):
+                loga2 = sci.log(a2)
+            self._terms = dict((s, sci.add(table, loga2, out=terms[s]))
+                               for s, table in tables.items())
+
+    @classmethod
+    def power_tables(cls, N, precision='float128'):
+        """
+        The k^2*pi^2 and 2*pi^(2s)*k^(2s) tables for k = 1, ..., N-1, which
+        only depend on the mesh size
+        """
+        return cls._power_tables(sci.arange(1, N, dtype=float), precision)
+
+    @classmethod
+    def _power_tables(cls, k, precision):
+        I = k*k
+        if precision == 'float128':
+            I = sci.float128(I)
+            tables = dict((s, 2*sci.pi**(2*s)*I**s)
+                          for s in xrange(2, cls.l+1))
+        else:
+            logI = sci.log(I)
+            tables = dict((s, sci.log(2) + 2*s*sci.log(sci.pi) + s*logI)
+                          for s in xrange(2, cls.l+1))
+        return I*sci.pi**2, tables
+
+    def __call__(self, t):
+        self.calls += 1
+        if self.precision == 'log':
+            return self._log_call(t)
+        f = sci.sum(self._terms[self.l]*sci.exp(-self._Ipi2*t))
+        for i, s in enumerate(xrange(self.l, 1, -1)):
+            time = (self._c[i]/f)**self._p[i]
+            f = sci.sum(self._terms[s]*sci.exp(-self._Ipi2*time))
+        return t-(2*self._M*sci.sqrt(sci.pi)*f)**(-2/5)
+
+    def _log_call(self, t):
+        logf = _logsumexp(self._terms[self.l] - self._Ipi2*t)
+        for i, s in enumerate(xrange(self.l, 1, -1)):
+            time = sci.exp((sci.log(self._c[i]) - logf)*self._p[i])
+            logf = _logsumexp(self._terms[s] - self._Ipi2*time)
+        return t-sci.exp(-2/5*(sci.log(2*self._M*sci.sqrt(sci.pi)) + logf))
+
+    def solve(self, a=0, initial_guess=None, b_max=0.1):
+        """
+        Finds the smallest t_star above a with brentq. Raises ValueError if
+        the fixed point equation does not change sign by b_max.
+
+        The equation is t - xi(t) with xi increasing in t, so every step
+        t -> xi(t) from below stays below the smallest root. The lower end
+        of the bracket is stepped up this way. Once the steps shrink, the
+        upper end is tried at 2, 4, 8, ... times the sum of the remaining
+        steps, extrapolated geometrically, until the equation is positive
+        there.
+        The equation often has several roots, and a fixed bracket such as
+        Botev's [0, b] can hold any number of them.
+
+        The steps start from a, or with initial_guess from guess/2, clipped
+        to b_max, moved down by factors of 4 towards a until the equation is
+        negative there. A guess below the root of similar data, or up to
+        twice it, finds the same root as a cold start. A guess that is not
+        positive is ignored.
+
+        The number of evaluations is kept in calls, the number of brentq
+        iterations in iterations, the bracket handed to brentq in bracket and
+        the equation at t_star in residual.
+        """
+        # brentq starts by evaluating both ends, which are already known
+        known = {}
+        def func(t):
+            if t not in known:
+                known[t] = self(t)
+            return known[t]
+
+        lo = a
+        if initial_guess is not None and initial_guess > 0:
+            lo = max(min(initial_guess, b_max)/2, a)
+            while lo > a and not func(lo) < 0:
+                lo = lo/4 if lo/4 > 1e-3*initial_guess else a
+        hi = lo
+        last = None
+        reach = 2
+        while func(lo) < 0:
+            step = -float(func(lo))
+            if not lo + step < b_max:
+                raise ValueError('no sign change of the fixed point '
+                                 'equation in [%g, %g]' % (lo, b_max))
+            if last is not None and step < last:
+                # The steps shrink by about step/last each time, so they
+                # add up to about step/(1 - step/last)
+                hi = min(lo + reach*step/(1 - step/last), b_max)
+                if func(hi) > 0:
+                    lo += step
+                    break
+                if hi == b_max:
+                    raise ValueError('no sign change of the fixed point '
+                                     'equation in [%g, %g]' % (lo, b_max))
+                reach *= 2
+            lo += step
+            last = step
+        t_star, result = scipy.optimize.brentq(func, lo, hi, full_output=True)
+        self.iterations = result.iterations
+        self.bracket = (lo, hi)
+        self.residual = known.get(t_star)
+        return t_star
+
+class _FixedPoint2D(object):
+    """
+    The fixed point equation of kde2d on the unit square, for the 2-D DCT
+    of the normalized histogram of M samples.
+    """
+    residual_tol = 1e-6
+
+    def __init__(self, M, DCTData):
+        self.M = M
+        N = len(DCTData)
+        # Botev's DCT halves the zero frequency row and column
+        a = DCTData.copy()
+        a[0, :] /= 2
+        a[:, 0] /= 2
+        self._A2 = a**2
+        self._Ipi2 = sci.arange(N)**2*sci.pi**2
+        w = sci.ones(N)/2
+        w[0] = 1
+        I = sci.arange(N, dtype=float)**2
+        self._weights = [w*I**s for s in xrange(6)]
+
+    def psi(self, s, t):
+        e = sci.exp(-self._Ipi2*t)
+        wx = e*self._weights[s[0]]
+        wy = e*self._weights[s[1]]
+        return ((-1)**sum(s)*sci.dot(wx, sci.dot(self._A2, wy))*
+                sci.pi**(2*sum(s)))
+
+    def func(self, s, t, cache):
+        if s in cache:
+            return cache[s]
+        if sum(s) <= 4:
+            Sum_func = (self.func((s[0]+1, s[1]), t, cache) +
+                        self.func((s[0], s[1]+1), t, cache))
+            const = (1 + 1/2**(sum(s)+1))/3
+            time = (-2*const*_K(s[0])*_K(s[1])/self.M/Sum_func)**(1/(2+sum(s)))
+            out = self.psi(s, time)
+        else:
+            out = self.psi(s, t)
+        cache[s] = out
+        return out
+
+    def evolve(self, t):
+        cache = {}
+        Sum_func = (self.func((0, 2), t, cache) + self.func((2, 0), t, cache) +
+                    2*self.func((1, 1), t, cache))
+        time = (2*sci.pi*self.M*Sum_func)**(-1/3)
+        return (t - time)/time
+
+    def solve(self):
+        """
+        Returns t_x, t_y. The root is bracketed by [0, tol], doubling tol up
+        to 0.1 from a starting point that grows with M, as in kde2d. If
+        there is no sign change by 0.1 the smallest |evolve| is searched for
+        with fminbound, as kde2d does, and ValueError is raised unless it is
+        a root to within a relative residual of residual_tol.
+        """
+        tol = _initial_bracket(self.M)
+        while True:
+            try:
+                t_star = scipy.optimize.brentq(self.evolve, 0, tol)
+                break
+            except ValueError:
+                if tol >= 0.1:
+                    t_star = scipy.optimize.fminbound(
+                        lambda t: abs(self.evolve(t)), 0, 0.1, xtol=1e-12)
+                    residual = abs(self.evolve(t_star))
+                    if not residual <= self.residual_tol:
+                        raise ValueError('no root of the fixed point '
+                                         'equation in [0, 0.1], smallest '
+                                         'residual %g' % residual)
+                    break
+                tol = min(2*tol, 0.1)
+        cache = {}
+        p_02 = self.func((0, 2), t_star, cache)
+        p_20 = self.func((2, 0), t_star, cache)
+        p_11 = self.func((1, 1), t_star, cache)
+        cross = 4*sci.pi*self.M*(p_11 + sci.sqrt(p_20*p_02))
+        t_x = (p_02**(3/4)/(cross*p_20**(3/4)))**(1/3)
+        t_y = (p_20**(3/4)/(cross*p_02**(3/4)))**(1/3)
+        return t_x, t_y
+
+def _initial_bracket(M):
+    """
+    Upper end of the first bracket of t_star, from Botev's kde.m
+    """
+    M = sci.clip(M, 50, 1050)
+    return 1e-12 + 0.01*(M - 50)/1000
+
+def _K(s):
+    return ((-1)**s*sci.prod(sci.arange(1, 2*s, 2, dtype=float))/
+            sci.sqrt(2*sci.pi))
+
+def _logsumexp(x, axis=None):
+    top = x.max(axis=axis)
+    if axis is None:
+        return top + sci.log(sci.sum(sci.exp(x - top)))
+    return top + sci.log(sci.sum(sci.exp(x - sci.expand_dims(top, axis)),
+                                 axis=axis))
+
+def _fixed_point_many(t, M, I, a2):
+    """
+    fixed_point evaluated for several histograms at once: t and M hold one
+    value per row of a2.
+    """
+    l=7
+    I = sci.float128(I)
+    M = sci.float128(M)
+    a2 = sci.float128(a2)
+    t = sci.float128(t)[:, None]
+    f = 2*sci.pi**(2*l)*sci.sum(I**l*a2*sci.exp(-I*sci.pi**2*t), axis=1)
+    for s in range(l, 1, -1):
+        K0 = sci.prod(xrange(1, 2*s, 2))/sci.sqrt(2*sci.pi)
+        const = (1 + (1/2)**(s + 1/2))/3
+        time=(2*const*K0/M/f)**(2/(3+2*s))
+        f=2*sci.pi**(2*s)*sci.sum(I**s*a2*sci.exp(-I*sci.pi**2*time[:, None]),
+                                  axis=1)
+    return (t[:, 0]-(2*M*sci.sqrt(sci.pi)*f)**(-2/5)).astype(float)
+
+def _log_fixed_point_many(t, M, logI, loga2):
+    """
+    _fixed_point_many in float64 with log-sum-exp sums, as in
+    FixedPointSolver with precision='log'. logI and loga2 are the logs of
+    I and a2, -inf where a2 is zero.
+    """
+    l = 7
+    Ipi2 = sci.exp(logI)*sci.pi**2
+    def logf(s, time):
+        return (sci.log(2) + 2*s*sci.log(sci.pi) +
+                _logsumexp(s*logI + loga2 - Ipi2*time[:, None], axis=1))
+    f = logf(l, t)
+    for s in range(l, 1, -1):
+        K0 = sci.prod(xrange(1, 2*s, 2))/sci.sqrt(2*sci.pi)
+        const = (1 + (1/2)**(s + 1/2))/3
+        time = sci.exp((sci.log(2*const*K0/M) - f)*2/(3+2*s))
+        f = logf(s, time)
+    return t-sci.exp(-2/5*(sci.log(2*M*sci.sqrt(sci.pi)) + f))
+
+def _bracket_many(func, args, b_max=0.1):
+    """
+    Brackets the smallest root of each problem as FixedPointSolver.solve
+    does without a guess: the lower ends are stepped up from zero through
+    t - func(t), and once the steps shrink the upper ends are tried at 2,
+    4, 8, ... times the extrapolated sum of the remaining steps until func
+    is positive there. Returns the lower and upper ends, nan where there is
+    no sign change by b_max.
+    """
+    n = len(args[0])
+    lo = sci.zeros(n)
+    hi = sci.zeros(n)
+    last = sci.nan*sci.ones(n)
+    reach = 2*sci.ones(n)
+    f = func(lo, *args)
+    active = sci.flatnonzero(f < 0)
+    while len(active):
+        sub = [x[active] for x in args]
+        step = -f[active]
+        failed = ~(lo[active] + step < b_max)
+        found = sci.zeros(len(active), dtype=bool)
+        trying = sci.flatnonzero(~failed & (step < last[active]))
+        if len(trying):
+            rows = active[trying]
+            h = sci.minimum(lo[rows] + reach[rows]*step[trying]/
+                            (1 - step[trying]/last[rows]), b_max)
+            fh = func(h, *[x[trying] for x in sub])
+            hi[rows] = h
+            found[trying] = fh > 0
+            failed[trying] |= ~(fh > 0) & (h == b_max)
+            reach[rows] *= 2
+        lo[active] = sci.where(failed, sci.nan, lo[active] + step)
+        hi[active[failed]] = sci.nan
+        last[active] = step
+        done = failed | found
+        active, sub = active[~done], [x[~done] for x in sub]
+        f[active] = func(lo[active], *sub)
+        active = active[f[active] < 0]
+    return lo, hi
+
+def _root_many(func, a, b, args=(), xtol=2e-12, rtol=4*sci.finfo(float).eps,
+               maxiter=100):
+    """
+    Vectorized Illinois (modified regula falsi) root finder.
+
+    func(x, *args) must accept an array x with one entry per problem and
+    return an array of the same shape. Every element of args has a leading
+    problem axis and is subset along with x as problems converge. Problems
+    with no sign change on [a, b] get nan.
+    """
+    n = len(args[0])
+    a = sci.ones(n)*a
+    b = sci.ones(n)*b
+    fa = func(a, *args)
+    fb = func(b, *args)
+    root = sci.where(fa == 0, a, sci.where(fb == 0, b, sci.nan))
+    active = sci.flatnonzero((sci.sign(fa)*sci.sign(fb) < 0))
+    a, b, fa, fb = a[active], b[active], fa[active], fb[active]
+    c = sci.inf*sci.ones(len(active))
+    side = sci.zeros(len(active), dtype=int)
+    for _ in xrange(maxiter):
+        if len(active) == 0:
+            break
+        sub = [x[active] for x in args]
+        c_old = c
+        c = (a*fb - b*fa)/(fb - fa)
+        fc = func(c, *sub)
+        # Replace the endpoint with the same sign as fc, halving the value
+        # kept at the other endpoint if it is retained twice in a row
+        left = sci.sign(fc) == sci.sign(fa)
+        fb = sci.where(left & (side == 1), fb/2, fb)
+        fa = sci.where(~left & (side == -1), fa/2, fa)
+        a = sci.where(left, c, a)
+        fa = sci.where(left, fc, fa)
+        b = sci.where(left, b, c)
+        fb = sci.where(left, fb, fc)
+        side = sci.where(left, 1, -1)
+        done = ((fc == 0) | (abs(c - c_old) <= xtol + rtol*abs(c)) |
+                (abs(b - a) <= xtol + rtol*abs(c)))
+        root[active[done]] = c[done]
+        keep = ~done
+        active, a, b, c = active[keep], a[keep], b[keep], c[keep]
+        fa, fb, side = fa[keep], fb[keep], side[keep]
+    root[active] = c
+    return root
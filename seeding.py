@@ -0,0 +1,20 @@
+#!/usr/bin/env python -tt
+"""
+Seeding shared by kde and the dgp test densities, so that seed=None, an int
+or a RandomState means the same everywhere in the package.
+
+Daniel B. Smith, PhD
+"""
+
+import numpy as np
+
+def random_state(seed):
+    """
+    Turns None, an int or a RandomState into a RandomState. None gives the
+    global numpy.random state, so numpy.random.seed still applies.
+    """
+    if seed is None:
+        return np.random.mtrand._rand
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python -tt
+"""
+A micro-batching front end to kde for serving many small requests.
+
+Requests are queued and a dispatcher thread collects those arriving within
+max_wait of each other into a batch. The batch is split by mesh
+configuration, and every fit group runs as a single kde.kde_many call on a
+thread or process pool, so concurrent requests share the Python overhead of
+the histogram, DCT, bandwidth and IDCT stages. Every request gets a Future.
+At most max_running groups are in the pool at once, so that overload backs
+up into the bounded queue, where it is rejected or expires.
+
+Daniel B. Smith, PhD
+"""
+
+from __future__ import division
+
+import sys
+import time
+import Queue
+import argparse
+import threading
+import collections
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+import kde
+
+class ServiceBusy(Exception):
+    """
+    Raised by submit when the queue already holds max_queue requests
+    """
+
+class DeadlineExceeded(Exception):
+    """
+    Set on the Future of a request still queued at its deadline
+    """
+
+class ResultTimeout(Exception):
+    """
+    Raised by Future.result when no result arrives within its timeout. The
+    request itself may still complete.
+    """
+
+class Future(object):
+    """
+    The eventual result of a request
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits up to timeout seconds for the result, raising the exception
+        of the request if it failed
+        """
+        if not self._event.wait(timeout) and not self._event.is_set():
+            raise ResultTimeout('no result after %g seconds' % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+class LatencyHistogram(object):
+    """
+    Counts of latencies in log spaced buckets from 100us, doubling up to
+    about 13s, with one overflow bucket.
+    """
+    bounds = 1e-4*2.0**np.arange(18)
+
+    def __init__(self):
+        self.counts = np.zeros(len(self.bounds) + 1, dtype=int)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.counts[self.bounds.searchsorted(seconds)] += 1
+            self.total += seconds
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th percentile, inf if it is
+        the overflow bucket and nan if nothing was recorded
+        """
+        n = self.counts.sum()
+        if n == 0:
+            return np.nan
+        i = np.cumsum(self.counts).searchsorted(q/100*n)
+        return self.bounds[i] if i < len(self.bounds) else np.inf
+
+    def as_dict(self):
+        n = int(self.counts.sum())
+        return {'count': n, 'mean': self.total/n if n else np.nan,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': zip(list(self.bounds) + [np.inf],
+                               self.counts.tolist())}
+
+_Request = collections.namedtuple('_Request', ['kind', 'key', 'args',
+                                               'future', 'submitted',
+                                               'deadline'])
+
+def _run_group(kind, key, args, deadlines, precision):
+    """
+    The pool task of one group of requests. Requests past their deadline
+    when it starts fail with DeadlineExceeded, and the rest are run,
+    returning one result or exception per request.
+    """
+    now = time.time()
+    late = [deadline is not None and now > deadline
+            for deadline in deadlines]
+    live = [a for a, expired in zip(args, late) if not expired]
+    if not live:
+        results = []
+    elif kind == 'fit':
+        N, default_limits = key
+        datasets = [data for data, limits in live]
+        MIN = None if default_limits else [limits[0] for data, limits in live]
+        MAX = None if default_limits else [limits[1] for data, limits in live]
+        results = _run_fits(N, MIN, MAX, datasets, precision)
+    else:
+        results = _run_evaluates(live)
+    results = iter(results)
+    return [DeadlineExceeded('past its deadline when its batch started')
+            if expired else next(results) for expired in late]
+
+def _run_fits(N, MIN, MAX, datasets, precision):
+    """
+    Fits a group of datasets sharing a mesh configuration, returning one
+    kde result or exception per dataset. If the joint kde_many fails each
+    dataset is retried alone, so that one bad request does not fail the
+    rest.
+    """
+    try:
+        return _fit_group(N, MIN, MAX, datasets, precision)
+    except Exception:
+        if len(datasets) == 1:
+            return [sys.exc_info()[1]]
+    results = []
+    for i, data in enumerate(datasets):
+        try:
+            results.extend(_fit_group(N, None if MIN is None else MIN[i:i+1],
+                                      None if MAX is None else MAX[i:i+1],
+                                      [data], precision))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def _fit_group(N, MIN, MAX, datasets, precision):
+    bandwidth, mesh, density = kde.kde_many(datasets, N, MIN, MAX,
+                                            precision=precision)
+    return [None if np.isnan(bandwidth[i])
+            else (bandwidth[i], mesh[i], density[i])
+            for i in xrange(len(datasets))]
+
+def _run_evaluates(requests):
+    """
+    Interpolates each (mesh, density, points) request, zero off the mesh,
+    returning one array or exception per request
+    """
+    results = []
+    for mesh, density, points in requests:
+        try:
+            results.append(np.interp(points, mesh, density, left=0,
+                                     right=0))
+        except Exception as e:
+            results.append(e)
+    return results
+
+class KDEService(object):
+    """
+    Thread safe micro-batching kde service.
+
+    Parameters
+    ----------
+    workers: int, optional
+             Size of the pool, default the number of CPUs
+    processes: bool
+               Run batches on a process pool instead of a thread pool. The
+               numpy stages release the GIL, so threads usually suffice.
+    max_batch: int
+               Most requests collected into one batch
+    max_wait: float
+              Seconds the dispatcher waits for more requests after the
+              first of a batch
+    max_queue: int
+               Most queued requests. Further submits raise ServiceBusy.
+    max_running: int, optional
+                 Most groups handed to the pool and not yet finished,
+                 default the size of the pool. The dispatcher waits for one
+                 to finish before handing over another, so under sustained
+                 load requests back up in the queue, where they are
+                 rejected or expire, rather than in the pool.
+    precision: 'float128' or 'log'
+               See kde.FixedPointSolver. 'log' is the default here as it
+               is much faster and latency matters more than matching kde
+               to the last digit.
+
+    Requests past their deadline when their group is handed to the pool,
+    or when it starts running there, fail with DeadlineExceeded; those
+    already running complete.
+    """
+    def __init__(self, workers=None, processes=False, max_batch=64,
+                 max_wait=0.002, max_queue=1024, precision='log',
+                 max_running=None):
+        self.max_batch = max_batch
+        self.precision = precision
+        self.max_wait = max_wait
+        if max_running is None:
+            max_running = workers or multiprocessing.cpu_count()
+        self._running = threading.Semaphore(max_running)
+        if processes:
+            self._pool = multiprocessing.Pool(workers)
+        else:
+            self._pool = multiprocessing.pool.ThreadPool(workers)
+        self._queue = Queue.Queue(maxsize=max_queue)
+        self._latency = {'fit': LatencyHistogram(),
+                         'evaluate': LatencyHistogram()}
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def submit_fit(self, data, N=None, MIN=None, MAX=None, timeout=None):
+        """
+        Queues kde.kde(data, N, MIN, MAX). Requests with the same N, and
+        either both or neither of MIN and MAX, are fitted together.
+
+        Returns
+        -------
+        Future of (bandwidth, mesh, density), or of None if the bandwidth
+        cannot be found
+        """
+        data = np.asarray(data, dtype=float).reshape(-1)
+        if not len(data):
+            raise ValueError('data is empty')
+        N = 2**14 if N is None else int(2**np.ceil(np.log2(N)))
+        limits = None if MIN is None or MAX is None else (MIN, MAX)
+        return self._submit('fit', (N, limits is None), (data, limits),
+                            timeout)
+
+    def submit_evaluate(self, fitted, points, timeout=None):
+        """
+        Queues the evaluation of a (bandwidth, mesh, density) result of
+        submit_fit or kde.kde at points, by linear interpolation.
+
+        Returns
+        -------
+        Future of an array of the shape of points
+        """
+        bandwidth, mesh, density = fitted
+        return self._submit('evaluate', len(mesh),
+                            (mesh, density, np.asarray(points, dtype=float)),
+                            timeout)
+
+    def _submit(self, kind, key, args, timeout):
+        now = time.time()
+        request = _Request(kind, key, args, Future(), now,
+                           None if timeout is None else now + timeout)
+        try:
+            self._queue.put_nowait(request)
+        except Queue.Full:
+            self._count('rejected')
+            raise ServiceBusy('%d requests queued' % self._queue.maxsize)
+        return request.future
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def _dispatch(self):
+        running = True
+        while running:
+            request = self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            end = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    request = self._queue.get(timeout=max(end - time.time(),
+                                                          0))
+                except Queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                batch.append(request)
+            self._start(batch)
+
+    def _start(self, batch):
+        groups = collections.OrderedDict()
+        for request in batch:
+            groups.setdefault((request.kind, request.key), []).append(request)
+        self._count('batches')
+        for (kind, key), requests in groups.items():
+            # Blocks while max_running groups are in the pool
+            self._running.acquire()
+            now = time.time()
+            live = []
+            for request in requests:
+                if request.deadline is not None and now > request.deadline:
+                    self._count('expired')
+                    request.future.set_exception(DeadlineExceeded(
+                        'queued for %g seconds' % (now - request.submitted)))
+                else:
+                    live.append(request)
+            if not live:
+                self._running.release()
+                continue
+            self._count('groups')
+            self._pool.apply_async(
+                _run_group, (kind, key, [r.args for r in live],
+                             [r.deadline for r in live], self.precision),
+                callback=self._finisher(kind, live))
+
+    def _finisher(self, kind, requests):
+        def finish(results):
+            self._running.release()
+            now = time.time()
+            for request, result in zip(requests, results):
+                if isinstance(result, DeadlineExceeded):
+                    self._count('expired')
+                    request.future.set_exception(result)
+                elif isinstance(result, Exception):
+                    self._count('failed')
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+                self._latency[kind].add(now - request.submitted)
+        return finish
+
+    def stats(self):
+        """
+        Queue depth, counts of batches, groups and rejected, expired and
+        failed requests, and the latency histogram of each kind of request
+        """
+        with self._lock:
+            out = dict(self._counts)
+        out['queue_depth'] = self._queue.qsize()
+        for kind, histogram in self._latency.items():
+            out['latency_' + kind] = histogram.as_dict()
+        return out
+
+    def close(self):
+        """
+        Finishes the queued requests and stops the dispatcher and the pool
+        """
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def main(argv=None):
+    """
+    Sends a burst of fit and evaluate requests on dgp_class samples to a
+    local KDEService and prints its statistics.
+    """
+    import dgp_class as dgp
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--nsamp', type=int, default=1000)
+    parser.add_argument('--nmesh', type=int, default=2**12)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--processes', action='store_true')
+    args = parser.parse_args(argv)
+    model = dgp.Claw()
+    state = np.random.RandomState(0)
+    samples = [model.sample(args.nsamp, seed=state)
+               for _ in xrange(args.requests)]
+    points = model.mesh(100)
+    start = time.time()
+    with KDEService(args.workers, args.processes,
+                    max_queue=args.requests) as service:
+        fits = [service.submit_fit(x, args.nmesh) for x in samples]
+        evaluations = [service.submit_evaluate(f.result(), points)
+                       for f in fits]
+        for f in evaluations:
+            f.result()
+        stats = service.stats()
+    print '%d requests in %.3f s' % (2*args.requests, time.time() - start)
+    for name, value in sorted(stats.items()):
+        if isinstance(value, dict):
+            value = dict((k, v) for k, v in value.items() if k != 'buckets')
+        print name, value
+    return None
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+    sys.exit(0)
@@ -1,18 +1,61 @@
 #!/usr/bin/env python -tt
+"""
+Plots of the kde of every dgp_class test density against its analytical pdf.
+
+The fits run on a process pool and are cached as .npz files keyed by class,
+Nsamp, Nmesh and seed, so the figures can be restyled and redrawn without
+sampling and fitting again.
+"""
 
 from __future__ import division
 
+import os
 import sys
 import inspect
+import argparse
+import tempfile
+import multiprocessing
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import kde
 import dgp_class as dgp
 
-def main(Nsamp=None, Nmesh=None):
+def _class_names():
+    return [name for name, cls in inspect.getmembers(dgp)
+            if inspect.isclass(cls) and not cls in (dgp.dgp, dgp.LogNormal)]
+
+def cache_path(cache_dir, name, Nsamp, Nmesh, seed):
+    return os.path.join(cache_dir, '%s_%d_%d_%d.npz' % (name, Nsamp, Nmesh,
+                                                        seed))
+
+def _compute(task):
     """
-    Generates plots for the 16 test cases for both the analytical pdf and the
-    kernel density estimate.
+    Samples and fits one class and writes its cache file, unless it exists.
+    Returns the path, or None if the bandwidth could not be found.
+    """
+    name, Nsamp, Nmesh, seed, path, force = task
+    if os.path.exists(path) and not force:
+        return path
+    model = getattr(dgp, name)()
+    x = model.sample(size=Nsamp, seed=seed)
+    out = kde.kde(x, N=Nmesh)
+    if out is None:
+        return None
+    bandwidth, mesh, density = out
+    handle, temp = tempfile.mkstemp(suffix='.npz',
+                                    dir=os.path.dirname(path) or '.')
+    with os.fdopen(handle, 'wb') as f:
+        np.savez(f, mesh=mesh, density=density, pdf=model.pdf(mesh),
+                 bandwidth=bandwidth)
+    os.rename(temp, path)
+    return path
+
+def compute(Nsamp=10000, Nmesh=2**14, seed=0, cache_dir='plot_cache',
+            names=None, processes=None, force=False):
+    """
+    Runs the fits for the named classes, default all, on a process pool.
 
     Parameters
     ----------
@@ -20,41 +63,100 @@ def main(Nsamp=None, Nmesh=None):
            Number of samples used for the kde
     Nmesh: int
            Number of points used for the mesh
+    seed: int
+          Seed of the samples of every class
+    cache_dir: str
+               Directory of the .npz cache
+    processes: int, optional
+               Size of the pool, default the number of CPUs
+    force: bool
+           Refit even if the cache file exists
+
+    Returns
+    -------
+    List of (name, path) pairs, path None where the fit failed
+    """
+    if names is None:
+        names = _class_names()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tasks = [(name, Nsamp, Nmesh, seed,
+              cache_path(cache_dir, name, Nsamp, Nmesh, seed), force)
+             for name in names]
+    pool = multiprocessing.Pool(processes)
+    try:
+        paths = pool.map(_compute, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return zip(names, paths)
+
+def render(name, path, out_dir='.'):
+    """
+    Draws the cached fit of one class and saves it as out_dir/name.pdf
+    """
+    stored = np.load(path)
+    try:
+        mesh = stored['mesh']
+        kdense = stored['density']
+        f = stored['pdf']
+    finally:
+        stored.close()
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    ax.set_title(name, size=36)
+
+    ax.plot(mesh, kdense)
+    ax.plot(mesh, f)
+    for label in ax.get_xticklabels() + ax.get_yticklabels():
+        label.set_fontsize(24)
+
+    fig.set_figheight(10)
+    fig.set_figwidth(12)
+    fig.savefig(os.path.join(out_dir, name+'.pdf'))
+    plt.close(fig)
+
+def main(Nsamp=None, Nmesh=None, seed=0, cache_dir='plot_cache', out_dir='.',
+         names=None, processes=None, force=False):
+    """
+    Generates plots for the 16 test cases for both the analytical pdf and the
+    kernel density estimate. See compute for the parameters.
     """
     if Nsamp is None:
         Nsamp = 10000
-    classes = [(cls, name) for name, cls in inspect.getmembers(dgp)
-               if inspect.isclass(cls) and not cls in (dgp.dgp, dgp.LogNormal)]
-    for cls, name in classes:
+    if Nmesh is None:
+        Nmesh = 2**14
+    for name, path in compute(Nsamp, Nmesh, seed, cache_dir, names,
+                              processes, force):
+        if path is None:
+            print 'No bandwidth found for', name
+            continue
         print 'Generating graph for', name
-        model = cls()
-        x = model.sample(size=Nsamp)
-        t, mesh, kdense = kde.kde(x, N=Nmesh)
-        f = model.pdf(mesh)
-        
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        ax.set_title(name, size=36)
-
-        plt.plot(mesh, kdense)
-        plt.plot(mesh, f)
-        for label in ax.get_xticklabels() + ax.get_yticklabels():
-            label.set_fontsize(24)
-
-        fig.set_figheight(10)
-        fig.set_figwidth(12)
-        fig.savefig(name+'.pdf')
-        plt.close()
-        
-
+        render(name, path, out_dir)
     return None
 
-if __name__ == "__main__":
-    answer = raw_input('Warning: This script generates 16 pdfs\n' +
-                       'Do you wish to continue? (Y/N)')
-    if answer in ('Y', 'y', 'yes', 'Yes', 'YES'):
-        main()
-        sys.exit(0)
-    else:
-        sys.exit(1)
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('names', nargs='*',
+                        help='dgp_class classes to plot, default all')
+    parser.add_argument('--nsamp', type=int, default=10000)
+    parser.add_argument('--nmesh', type=int, default=2**14)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache-dir', default='plot_cache')
+    parser.add_argument('--out-dir', default='.')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--force', action='store_true',
+                        help='refit even if the cache exists')
+    args = parser.parse_args(argv)
+    known = _class_names()
+    for name in args.names:
+        if name not in known:
+            parser.error('unknown class %s' % name)
+    return args
 
+if __name__ == "__main__":
+    args = _parse_args(sys.argv[1:])
+    main(args.nsamp, args.nmesh, args.seed, args.cache_dir, args.out_dir,
+         args.names or None, args.processes, args.force)
+    sys.exit(0)